@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SCRIPT : fake_rsync.py                                #
+#          rsync stub for the SyncWatch benchmark,      #
+#          records its invocations                      #
+#########################################################
+
+####################### IMPORTS #########################
+import sys
+import os
+import time
+import json
+import shutil
+from fnmatch import fnmatch
+
+#########################################################
+# Class : FakeRsync                                     #
+#########################################################
+class FakeRsync(object):
+    # Records every invocation as a json line in $SYNCWATCH_BENCH_LOG.
+    # With $SYNCWATCH_BENCH_COPY set, local files are copied the way rsync
+    # does (temp file .name.xxxxxx, then rename), so the destination sees
+    # the same events as with rsync.
+    def __init__(self, argv):
+        self.argv=argv
+        self.filesfrom=None
+        self.from0=False
+        self.delete=False
+        self.excludes=[]
+        self.paths=[]
+        self.transferred=0
+        self.size=0
+        self.deleted=0
+        for arg in argv:
+            if arg.startswith("--files-from="):
+                self.filesfrom=arg.split("=",1)[1]
+            elif arg == "--from0":
+                self.from0=True
+            elif arg in ("--delete", "--delete-missing-args"):
+                self.delete=True
+            elif arg.startswith("--exclude="):
+                self.excludes.append(arg.split("=",1)[1])
+            elif not arg.startswith("-"):
+                self.paths.append(arg)
+
+    def run(self):
+        start=time.time()
+        source=self.paths[-2]
+        destination=self.paths[-1]
+        changes=None
+        if self.filesfrom:
+            with open(self.filesfrom, "rb") as listfile:
+                sep = b"\0" if self.from0 else b"\n"
+                changes=[os.fsdecode(path) for path in listfile.read().split(sep) if path]
+        delay=float(os.environ.get("SYNCWATCH_BENCH_DELAY", "0"))
+        if delay:
+            time.sleep(delay)
+        if os.environ.get("SYNCWATCH_BENCH_COPY"):
+            if changes == None:
+                self._copyTree(source, destination)
+            else:
+                for path in changes:
+                    self._copyPath(os.path.join(source, path), os.path.join(destination, path))
+        self._printStats()
+        logfile=os.environ.get("SYNCWATCH_BENCH_LOG")
+        if logfile:
+            record={"start":start, "end":time.time(), "argv":self.argv, "changes":None if changes == None else len(changes)}
+            with open(logfile, "a") as log_file:
+                log_file.write(json.dumps(record)+"\n")
+        return 0
+
+    def _excluded(self, name):
+        for exclude in self.excludes:
+            if fnmatch(name, exclude):
+                return True
+        return False
+
+    def _copyTree(self, source, destination):
+        for dirpath, dirnames, filenames in os.walk(source):
+            relpath=os.path.relpath(dirpath, source)
+            dirnames[:]=[dirname for dirname in dirnames if not self._excluded(dirname)]
+            for name in dirnames + filenames:
+                if not self._excluded(name):
+                    self._copyPath(os.path.join(dirpath, name), os.path.normpath(os.path.join(destination, relpath, name)), False)
+
+    def _copyPath(self, src, dst, recursive = True):
+        if os.path.isdir(src):
+            os.makedirs(dst, exist_ok=True)
+            if recursive:
+                self._copyTree(src, dst)
+        elif os.path.isfile(src):
+            if os.path.isfile(dst) and os.stat(src).st_mtime <= os.stat(dst).st_mtime:
+                return
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp=os.path.join(os.path.dirname(dst), ".{}.{}".format(os.path.basename(dst), "XyZ123"))
+            shutil.copy2(src, tmp)
+            os.rename(tmp, dst)
+            self.transferred+=1
+            self.size+=os.path.getsize(dst)
+        elif self.delete and os.path.lexists(dst):
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            else:
+                os.remove(dst)
+            self.deleted+=1
+
+    def _printStats(self):
+        print("Number of files: {}".format(self.transferred))
+        print("Number of deleted files: {}".format(self.deleted))
+        print("Number of regular files transferred: {}".format(self.transferred))
+        print("Total transferred file size: {} bytes".format(self.size))
+
+#########################################################
+if __name__ == "__main__":
+    sys.exit(FakeRsync(sys.argv[1:]).run())
@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SCRIPT : syncwatch_bench.py                           #
+#          Benchmark for SyncWatch event handling       #
+#          and syncing with a fake rsync                #
+#########################################################
+
+####################### GLOBALS #########################
+DEF_FILES    = 10000
+DEF_JOBS     = 20
+DEF_DEPTH    = 10
+DEF_ROUNDS   = 20
+DEF_DELAY    = 1
+SETTLE_TIME  = 2
+MAX_SETTLE   = 300
+WORKLOADS    = ["bulk", "deeprename", "pingpong", "manyjobs"]
+ENGINES      = ["thread", "asyncio"]
+
+####################### IMPORTS #########################
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import resource
+import logging
+import threading
+from getopt import getopt, GetoptError
+from multiprocessing import Process
+
+BENCHPATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHPATH, "..", "opt", "syncwatch"))
+import syncwatch
+
+#########################################################
+# Class : BenchRun                                      #
+#########################################################
+class BenchRun(object):
+    # One workload on a fresh tree, with the SyncWatch components set up
+    # the way SyncWatch.run does
+    def __init__(self, basedir, name, delay):
+        self.name=name
+        self.delay=delay
+        self.path=tempfile.mkdtemp(prefix="syncwatch-bench-{}-".format(name), dir=basedir)
+        self.logfile=os.path.join(self.path, "rsync.log")
+        self.logger=logging.getLogger('syncwatch')
+        self.syncs=[]
+        self.metrics=None
+        self.scheduler=None
+        self.watcher=None
+        self.engine=None
+        self.before={}
+        self.runsbefore=0
+        self.threads=0
+
+    def setup(self, jobs, reversesync = False, maxsyncs = syncwatch.DEF_MAXSYNCS, engine = "thread"):
+        xml=["<syncs>", "<settings><maxsyncs>{}</maxsyncs></settings>".format(maxsyncs)]
+        for job in range(jobs):
+            source=os.path.join(self.path, "src{}".format(job))
+            destination=os.path.join(self.path, "dst{}".format(job))
+            os.makedirs(source)
+            os.makedirs(destination)
+            xml.append("<job{}><source>{}</source><destination>{}</destination><delay>{}</delay>"
+                       "<resettimer>true</resettimer><reversesync>{}</reversesync><incremental>true</incremental>"
+                       "<delete>true</delete></job{}>".format(job, source, destination, self.delay, str(reversesync).lower(), job))
+        xml.append("</syncs>")
+        XMLpath=os.path.join(self.path, syncwatch.XML_FILENAME)
+        with open(XMLpath, "w") as xml_file:
+            xml_file.write("\n".join(xml))
+        os.environ["SYNCWATCH_BENCH_LOG"]=self.logfile
+        settings, self.syncs = syncwatch.SyncWatch.ParseXML(XMLpath, self.logger)
+        self.metrics=syncwatch.SyncMetrics(self.logger, None, None)
+        self.scheduler=syncwatch.SyncScheduler(self.logger, self.metrics, settings['maxsyncs'], syncwatch.DEF_DEVSYNCS)
+        if engine == "asyncio":
+            self.engine=syncwatch.AsyncEngine(self.logger)
+        else:
+            self.engine=syncwatch.ThreadEngine()
+        self.engine.start()
+        self.watcher=syncwatch.WatchEngine(self.logger)
+        self.watcher.start()
+        for sync in self.syncs:
+            sync['handler']=syncwatch.SyncHandler(self.logger, sync, self.scheduler, self.metrics, self.engine)
+            self.watcher.schedule(sync['handler'], sync['source'])
+
+    def teardown(self):
+        self.watcher.stop()
+        for sync in self.syncs:
+            sync['handler'].timer.clear()
+            if sync['handler'].rsync.syncThread:
+                sync['handler'].rsync.syncThread.join()
+            sync['handler']=None
+        self.engine.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def measure(self, workload, *args):
+        # Runs workload in a child process, so only SyncWatch is measured
+        usage=resource.getrusage(resource.RUSAGE_SELF)
+        self.before=dict(self.metrics.values)
+        self.runsbefore=len(self.getRuns())
+        self.threads=threading.active_count()
+        start=time.time()
+        process=Process(target=workload, args=(self,)+args)
+        process.start()
+        process.join()
+        written=time.time()
+        settled=self.settle()
+        end=time.time()
+        usage_end=resource.getrusage(resource.RUSAGE_SELF)
+        return self.report(start, written, settled, end, usage, usage_end)
+
+    def settle(self):
+        # Wait until nothing is pending or running, return the time of the last activity
+        last=time.time()
+        lastruns=-1
+        while time.time() - last < SETTLE_TIME and time.time() - last < MAX_SETTLE:
+            time.sleep(0.1)
+            self.threads=max(self.threads, threading.active_count())
+            runs=len(self.getRuns())
+            busy=runs != lastruns or self.scheduler.running or self.scheduler.queue
+            for sync in self.syncs:
+                handler=sync['handler']
+                if handler.timer.timerBusy.is_set() or handler.rsync.busy:
+                    busy=True
+            if busy:
+                last=time.time()
+            lastruns=runs
+        return last
+
+    def getRuns(self):
+        runs=[]
+        if os.path.isfile(self.logfile):
+            with open(self.logfile, "r") as log_file:
+                for line in log_file:
+                    runs.append(json.loads(line))
+        return runs
+
+    def getMetric(self, name):
+        # change since the start of the measurement
+        value=0
+        for (key, labels), metric in list(self.metrics.values.items()):
+            if key == name:
+                value+=metric - self.before.get((key, labels), 0)
+        return value
+
+    def report(self, start, written, settled, end, usage, usage_end):
+        events=self.getMetric("events_total") + self.getMetric("events_ignored_total")
+        latencies=self.getMetric("latency_seconds_count")
+        runs=self.getRuns()[self.runsbefore:]
+        cpu=(usage_end.ru_utime - usage.ru_utime) + (usage_end.ru_stime - usage.ru_stime)
+        with open("/proc/self/statm", "r") as statm:
+            rss=int(statm.read().split()[1]) * resource.getpagesize()
+        result={"workload": self.name,
+                "events": events,
+                "ignored": self.getMetric("events_ignored_total"),
+                "eventrate": events / max(end - start - SETTLE_TIME, 0.001),
+                "cpu": cpu,
+                "rss": rss / (1024*1024),
+                "maxrss": usage_end.ru_maxrss / 1024,
+                "threads": self.threads,
+                "runs": self.getMetric("sync_duration_seconds_count"),
+                "fullruns": len([run for run in runs if run["changes"] == None]),
+                "latency": self.getMetric("latency_seconds_sum") / latencies if latencies else 0,
+                "settle": settled - written if settled else 0}
+        return result
+
+#########################################################
+# Class : Workloads                                     #
+#########################################################
+class Workloads(object):
+    @classmethod
+    def bulk(cls, run, files):
+        source=run.syncs[0]['source']
+        for i in range(files):
+            folder=os.path.join(source, "dir{}".format(i // 100))
+            if not i % 100:
+                os.makedirs(folder)
+            with open(os.path.join(folder, "file{}".format(i)), "w") as bench_file:
+                bench_file.write("x" * 128)
+
+    @classmethod
+    def deeptree(cls, run, depth, files):
+        folder=run.syncs[0]['source']
+        for level in range(depth):
+            folder=os.path.join(folder, "level{}".format(level))
+            os.makedirs(folder)
+            for i in range(files // depth):
+                with open(os.path.join(folder, "file{}".format(i)), "w") as bench_file:
+                    bench_file.write("x" * 128)
+
+    @classmethod
+    def deeprename(cls, run):
+        source=run.syncs[0]['source']
+        os.rename(os.path.join(source, "level0"), os.path.join(source, "renamed"))
+
+    @classmethod
+    def pingpong(cls, run, rounds):
+        for i in range(rounds):
+            for side in ('source', 'destination'):
+                with open(os.path.join(run.syncs[0][side], "{}{}".format(side, i)), "w") as bench_file:
+                    bench_file.write("x" * 128)
+            time.sleep(run.delay / 2)
+
+    @classmethod
+    def manyjobs(cls, run, files):
+        for sync in run.syncs:
+            for i in range(files):
+                with open(os.path.join(sync['source'], "file{}".format(i)), "w") as bench_file:
+                    bench_file.write("x" * 128)
+
+#########################################################
+# Class : SyncWatchBench                                #
+#########################################################
+class SyncWatchBench(object):
+    def __init__(self):
+        self.basedir="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.workloads=WORKLOADS
+        self.files=DEF_FILES
+        self.jobs=DEF_JOBS
+        self.depth=DEF_DEPTH
+        self.rounds=DEF_ROUNDS
+        self.delay=DEF_DELAY
+        self.loglevel=logging.CRITICAL
+        self.engine=ENGINES[0]
+
+    def run(self, argv):
+        self.parseopts(argv)
+        logger=logging.getLogger('syncwatch')
+        logger.setLevel(self.loglevel)
+        logger.addHandler(logging.StreamHandler(sys.stderr))
+        syncwatch.SYNC_TOOL=os.path.join(BENCHPATH, "fake_rsync.py")
+        os.environ["SYNCWATCH_BENCH_COPY"]="1"
+        results=[]
+        for workload in self.workloads:
+            results.append(getattr(self, "bench_"+workload)())
+        self.printResults(results)
+
+    def bench_bulk(self):
+        run=BenchRun(self.basedir, "bulk", self.delay)
+        run.setup(1, engine=self.engine)
+        try:
+            return run.measure(Workloads.bulk, self.files)
+        finally:
+            run.teardown()
+
+    def bench_deeprename(self):
+        run=BenchRun(self.basedir, "deeprename", self.delay)
+        run.setup(1, engine=self.engine)
+        try:
+            run.measure(Workloads.deeptree, self.depth, self.files)
+            return run.measure(Workloads.deeprename)
+        finally:
+            run.teardown()
+
+    def bench_pingpong(self):
+        run=BenchRun(self.basedir, "pingpong", self.delay)
+        run.setup(1, True, engine=self.engine)
+        try:
+            return run.measure(Workloads.pingpong, self.rounds)
+        finally:
+            run.teardown()
+
+    def bench_manyjobs(self):
+        run=BenchRun(self.basedir, "manyjobs", self.delay)
+        run.setup(self.jobs, engine=self.engine)
+        try:
+            return run.measure(Workloads.manyjobs, max(self.files // self.jobs, 1))
+        finally:
+            run.teardown()
+
+    def printResults(self, results):
+        print("{:<12}{:>9}{:>9}{:>10}{:>8}{:>9}{:>9}{:>8}{:>6}{:>6}{:>9}{:>9}".format(
+            "workload", "events", "ignored", "events/s", "cpu s", "rss MB", "peak MB", "threads", "runs", "full", "latency", "settle"))
+        for result in results:
+            print("{workload:<12}{events:>9}{ignored:>9}{eventrate:>10.0f}{cpu:>8.2f}{rss:>9.1f}{maxrss:>9.1f}{threads:>8}{runs:>6}{fullruns:>6}{latency:>9.2f}{settle:>9.2f}".format(**result))
+
+    def parseopts(self, argv):
+        try:
+            opts, args = getopt(argv,"hw:n:j:l:r:d:b:e:v",["help","workloads=","files=","jobs=","depth=","rounds=","delay=","basedir=","engine=","verbose"])
+        except GetoptError:
+            print("Enter 'syncwatch_bench.py -h' for help")
+            exit(2)
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print("Usage:")
+                print("         syncwatch_bench.py <args>")
+                print("         -h, --help             : this help file")
+                print("         -w, --workloads <list> : comma separated workloads, default {}".format(",".join(WORKLOADS)))
+                print("         -n, --files <n>        : number of files to write, default {}".format(DEF_FILES))
+                print("         -j, --jobs <n>         : number of jobs for manyjobs, default {}".format(DEF_JOBS))
+                print("         -l, --depth <n>        : folder depth for deeprename, default {}".format(DEF_DEPTH))
+                print("         -r, --rounds <n>       : rounds for pingpong, default {}".format(DEF_ROUNDS))
+                print("         -d, --delay <s>        : sync delay, default {}".format(DEF_DELAY))
+                print("         -b, --basedir <path>   : folder for the test trees, default /dev/shm")
+                print("         -e, --engine <engine>  : {}, default {}".format(" or ".join(ENGINES), ENGINES[0]))
+                print("         -v, --verbose          : log syncwatch output")
+                exit()
+            elif opt in ("-w", "--workloads"):
+                self.workloads=[workload.strip() for workload in arg.split(',')]
+                for workload in self.workloads:
+                    if not workload in WORKLOADS:
+                        print("Unknown workload: {}".format(workload))
+                        exit(2)
+            elif opt in ("-n", "--files"):
+                self.files=int(arg)
+            elif opt in ("-j", "--jobs"):
+                self.jobs=int(arg)
+            elif opt in ("-l", "--depth"):
+                self.depth=int(arg)
+            elif opt in ("-r", "--rounds"):
+                self.rounds=int(arg)
+            elif opt in ("-d", "--delay"):
+                self.delay=float(arg)
+            elif opt in ("-b", "--basedir"):
+                self.basedir=arg
+            elif opt in ("-e", "--engine"):
+                if not arg in ENGINES:
+                    print("Unknown engine: {}".format(arg))
+                    exit(2)
+                self.engine=arg
+            elif opt in ("-v", "--verbose"):
+                self.loglevel=logging.INFO
+
+#########################################################
+if __name__ == "__main__":
+    SyncWatchBench().run(sys.argv[1:])
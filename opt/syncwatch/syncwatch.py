@@ -17,7 +17,43 @@ LOG_MAXSIZE  = 100*1024*1024
 DEF_DELAY    = 10
 SYNC_WAIT    = 1
 RETRY_DELAY  = 10
+RETRY_MAX    = 320
+MOUNTINFO    = "/proc/self/mountinfo"
 TS_FILENAME  = ".syncwatch"
+INC_MAXFILES = 10000
+DEF_MAXSYNCS = 4
+DEF_DEVSYNCS = 2
+PRIO_AGING   = 60
+SETTINGS_TAG = "settings"
+OUTPUT_TAIL  = 20
+LOG_SUMMARY  = 10
+SCRUB_RATE   = 10
+FILTER_CACHE = 10000
+COPY_MAXFILE = 100
+COPY_MAXSIZE = 16*1024*1024
+LARGE_FILE   = 64
+LARGE_CHECK  = 1000
+BW_MIN       = 16
+NICE_TOOL    = "nice"
+IONICE_TOOL  = "ionice"
+IONICE_CLASS = {"realtime": 1, "besteffort": 2, "idle": 3}
+NOCOMPRESS   = ["7z", "aac", "avi", "bz2", "deb", "flac", "gif", "gz", "iso", "jpeg", "jpg", "lz", "lz4", "lzma", "mkv",
+                "mov", "mp3", "mp4", "ogg", "png", "rar", "rpm", "tbz", "tgz", "txz", "webm", "webp", "xz", "zip", "zst"]
+READ_CHUNK   = 65536
+DEB_MIN      = 1
+DEB_FACTOR   = 4
+DEB_WEIGHT   = 0.2
+QUIET_FILES  = 1000
+SNAP_WORKERS = 8
+JOURNAL_DIR  = "/var/lib/syncwatch"
+CHG_EVENTS   = ["created", "modified", "deleted", "moved"]
+CHG_DIR      = 0x01
+CHG_CREATED  = 0x02
+CHG_MODIFIED = 0x04
+CHG_DELETED  = 0x08
+CHG_TRANSFER = 0x10
+CHG_SUBTREE  = 0x20
+CHG_VERIFY   = 0x40
 
 ####################### IMPORTS #########################
 import sys
@@ -29,8 +65,21 @@ import logging
 import logging.handlers
 import locale
 import time
-from threading import Thread, Timer, Lock, Event
-from subprocess import run, PIPE, DEVNULL
+import tempfile
+import re
+import select
+import asyncio
+import codecs
+import shutil
+import stat
+import hashlib
+import struct
+import atexit
+import queue
+from collections import deque
+from threading import Thread, Timer, Lock, RLock, Event
+from subprocess import Popen, PIPE
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
@@ -66,28 +115,35 @@ class Common(object):
 
         return retval
 
+    @classmethod
+    def isremote(cls, path):
+        # host:path or rsync://host/path
+        return not os.path.isabs(path) and ':' in path.split('/')[0]
+
     @classmethod
     def which(cls, progr):
-        retval = None
-        try:
-            result = run(['which', progr], stdout=PIPE, stderr=DEVNULL)
-            if result.returncode == 0:
-                retval = result.stdout.decode("utf-8").strip()
-            else:
-                retval = None
-        except:
-            retval = None
-        return retval
+        return shutil.which(progr)
 
 #########################################################
 # Class : SyncTimer                                     #
 #########################################################
 class SyncTimer(object):
-    def __init__(self, delay, resettimer, callback):
+    # Debounce timer. The callback runs delay seconds after the first event,
+    # or with resettimer once no event came in for delay seconds. A running
+    # timer is checked again when it fires instead of being re-armed on every
+    # event. maxdelay caps the time from the first event to the callback,
+    # adaptive shortens the quiet time for fast bursts of events.
+    def __init__(self, engine, delay, resettimer, callback, maxdelay = 0, adaptive = False):
+        self.engine=engine
         self.delay=delay
         self.resettimer=resettimer
         self.callback=callback
+        self.maxdelay=maxdelay
+        self.adaptive=adaptive
         self.timer = None
+        self.started = 0
+        self.lastevent = 0
+        self.interval = 0
         self.timerBusy = Event()
         self.timerBusy.clear()
         self.mutex = Lock()
@@ -103,33 +159,434 @@ class SyncTimer(object):
 
     def start(self):
         self.mutex.acquire()
-        if self.timerBusy.isSet() and self.timer:
-            if self.resettimer:
-                self.timer.cancel()
-                self.timer = None
-                self.timerBusy.clear()
+        now = time.time()
+        if self.lastevent and now - self.lastevent < self.delay:
+            # moving average of the time between events in a burst
+            gap = now - self.lastevent
+            if self.interval:
+                self.interval += (gap - self.interval) * DEB_WEIGHT
+            else:
+                self.interval = gap
+        self.lastevent = now
         if not self.timerBusy.isSet() and not self.timer:
-            self.timer = Timer(self.delay, self.callback)
-            self.timer.start()
+            if not self.started:
+                self.started = now
+            delay = self.getDelay()
+            if self.adaptive and self.resettimer:
+                # check early, the event rate is not known yet
+                delay = min(delay, DEB_MIN)
+            self._arm(self._capDelay(delay, now))
+            self.timerBusy.set()
+        self.mutex.release()
+
+    def postpone(self, delay):
+        # runs the callback again after delay, returns False if maxdelay is reached
+        self.mutex.acquire()
+        delay = self._capDelay(delay, time.time())
+        if delay > 0:
+            self._arm(delay)
+        self.mutex.release()
+        return delay > 0
+
+    def retry(self, delay):
+        # starts the timer with delay, events don't restart it before it runs
+        self.mutex.acquire()
+        if not self.timerBusy.isSet() and not self.timer:
+            self.started = time.time()
+            self._arm(delay)
             self.timerBusy.set()
         self.mutex.release()
 
+    def getDelay(self):
+        if self.adaptive and self.interval:
+            return min(self.delay, max(DEB_MIN, self.interval * DEB_FACTOR))
+        return self.delay
+
     def clear(self):
+        # returns the time waited since the timer was started
+        waited = 0
         self.mutex.acquire()
         if self.timerBusy.isSet() and self.timer:
             self.timer.cancel()
             self.timer = None
+        if self.started:
+            waited = time.time() - self.started
+            self.started = 0
         self.timerBusy.clear()
         self.mutex.release()
+        return waited
+
+    def _arm(self, delay):
+        self.timer = self.engine.callLater(delay, self._onTimer)
+
+    def _capDelay(self, delay, now):
+        if self.maxdelay and self.started:
+            delay = min(delay, self.started + self.maxdelay - now)
+        return delay
+
+    def _onTimer(self):
+        self.mutex.acquire()
+        self.timer = None
+        if self.resettimer:
+            now = time.time()
+            delay = self._capDelay(self.lastevent + self.getDelay() - now, now)
+            if delay > 0:
+                self._arm(delay)
+        self.mutex.release()
+        if not self.timer:
+            self.callback()
+
+#########################################################
+# Class : PathIndex                                     #
+#########################################################
+class PathIndex(object):
+    # Paths keyed by their path relative to root, with a count of every
+    # parent folder to look up folder events in O(path depth)
+    def __init__(self, root):
+        if root:
+            self.root=os.path.normpath(root)
+        else:
+            self.root=""
+        self.prefix=os.path.join(self.root,'')
+        self.entries={}
+        self.parents={}
+        self.seq=0
+        self.mutex=Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def relpath(self, path):
+        relpath = None
+        if path.startswith(self.prefix):
+            relpath = os.path.normpath(path[len(self.prefix):])
+        elif os.path.normpath(path) == self.root:
+            relpath = os.curdir
+        return relpath
+
+    def mark(self):
+        return self.seq
+
+    def discard(self, mark):
+        # Entries added or updated after mark are kept
+        self.mutex.acquire()
+        for relpath in [relpath for relpath, entry in self.entries.items() if entry[1] <= mark]:
+            self._remove(relpath)
+        self._discarded()
+        self.mutex.release()
+
+    def _insert(self, relpath, flags):
+        self.seq += 1
+        if relpath in self.entries:
+            del self.entries[relpath]
+        else:
+            parent = os.path.dirname(relpath)
+            while parent:
+                self.parents[parent]=self.parents.get(parent, 0) + 1
+                parent = os.path.dirname(parent)
+        self.entries[relpath]=(flags, self.seq)
+
+    def _discarded(self):
+        pass
+
+    def _remove(self, relpath):
+        del self.entries[relpath]
+        parent = os.path.dirname(relpath)
+        while parent:
+            self.parents[parent]-=1
+            if not self.parents[parent]:
+                del self.parents[parent]
+            parent = os.path.dirname(parent)
+
+#########################################################
+# Class : ChangeSet                                     #
+#########################################################
+class ChangeSet(PathIndex):
+    # Ordered set of pending changes, one (flags, seq) entry per path.
+    # Changes inside a created, deleted or moved folder are folded into the
+    # folder and when maxsize is exceeded everything is folded into the root,
+    # which means a full sync is needed.
+    def __init__(self, root, maxsize):
+        PathIndex.__init__(self, root)
+        self.maxsize=maxsize
+        self.journal=None
+        self.sent=0
+
+    def add(self, relpath, isdir, evtype):
+        self.mutex.acquire()
+        ancestor = self._getFolded(relpath)
+        if ancestor:
+            # already covered, only mark it as changed again
+            self._insert(ancestor, self.entries[ancestor][0] | (CHG_VERIFY if evtype == "drift" else 0))
+        else:
+            if relpath in self.entries:
+                oldflags = self.entries[relpath][0]
+                if self.entries[relpath][1] <= self.sent:
+                    # created on the destination by the running sync
+                    oldflags &= ~CHG_CREATED
+            else:
+                oldflags = CHG_DIR if isdir else 0
+            flags = self._merge(oldflags, evtype)
+            self._update(relpath, flags, flags != oldflags or not relpath in self.entries)
+        self.mutex.release()
+
+    def mark(self):
+        # entries up to the mark are being synchronized
+        self.mutex.acquire()
+        self.sent = self.seq
+        self.mutex.release()
+        return self.sent
+
+    def setFull(self):
+        self.mutex.acquire()
+        self._update(os.curdir, 0)
+        self.mutex.release()
+
+    def attachJournal(self, journal):
+        # Replays the changes from the journal, returns the number of pending changes
+        self.mutex.acquire()
+        for relpath, flags in journal.load():
+            if not self._getFolded(relpath):
+                self._update(relpath, flags, False)
+        self.journal = journal
+        self.journal.compact(self.entries)
+        self.mutex.release()
+        return len(self.entries)
+
+    def syncJournal(self):
+        self.mutex.acquire()
+        if self.journal:
+            self.journal.sync()
+        self.mutex.release()
+
+    def closeJournal(self):
+        self.mutex.acquire()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        self.mutex.release()
+
+    def getFiles(self, maxfiles):
+        # changed files, empty if folded into folders
+        self.mutex.acquire()
+        files = [relpath for relpath, entry in self.entries.items() if not entry[0] & CHG_DIR]
+        self.mutex.release()
+        if len(files) > maxfiles or os.curdir in self.entries:
+            files = []
+        return files
+
+    def getPaths(self, mark):
+        # None if a full sync is needed
+        paths = []
+        self.mutex.acquire()
+        for relpath, entry in self.entries.items():
+            if entry[1] <= mark and (entry[0] & CHG_TRANSFER):
+                if relpath == os.curdir:
+                    paths = None
+                    break
+                paths.append(relpath)
+        self.mutex.release()
+        return paths
+
+    def getVerified(self, mark):
+        # paths to transfer without the quick check of size and mtime
+        self.mutex.acquire()
+        verified = set(relpath for relpath, entry in self.entries.items() if entry[1] <= mark and (entry[0] & CHG_VERIFY) and relpath != os.curdir)
+        self.mutex.release()
+        return verified
+
+    def _merge(self, flags, evtype):
+        if evtype == "deleted":
+            # also when created before: a file moved over an existing one
+            # is reported as created, missing on both sides is no error
+            flags |= CHG_DELETED | CHG_TRANSFER
+        elif evtype == "drift":
+            # contents found different by the scrub, size and mtime may be equal
+            flags |= CHG_VERIFY | CHG_TRANSFER
+            if not (flags & CHG_DIR):
+                flags |= CHG_MODIFIED
+        elif evtype == "created":
+            if not flags & (CHG_MODIFIED | CHG_DELETED):
+                flags |= CHG_CREATED
+            elif (flags & CHG_DELETED) and not (flags & CHG_CREATED):
+                flags |= CHG_MODIFIED
+            flags = (flags & ~CHG_DELETED) | CHG_TRANSFER
+        elif not (flags & CHG_DIR):
+            flags |= CHG_MODIFIED | CHG_TRANSFER
+        if (flags & CHG_DIR) and (flags & (CHG_CREATED | CHG_DELETED)):
+            # Modified folders are only reported for changes in their contents
+            flags |= CHG_SUBTREE | CHG_TRANSFER
+        return flags
+
+    def _update(self, relpath, flags, journal = True):
+        if relpath == os.curdir:
+            self._fold()
+        else:
+            if (flags & CHG_SUBTREE) and relpath in self.parents:
+                for child in [child for child in self.entries if child.startswith(os.path.join(relpath,''))]:
+                    self._remove(child)
+            self._insert(relpath, flags)
+            if len(self.entries) > self.maxsize:
+                self._fold()
+        if journal and self.journal:
+            if os.curdir in self.entries:
+                self.journal.append(os.curdir, self.entries[os.curdir][0])
+            else:
+                self.journal.append(relpath, flags)
+
+    def _discarded(self):
+        if self.journal:
+            self.journal.compact(self.entries)
+
+    def _getFolded(self, relpath):
+        parent = relpath
+        while parent:
+            parent = os.path.dirname(parent)
+            entry = self.entries.get(parent or os.curdir)
+            if entry and (entry[0] & CHG_SUBTREE):
+                return parent or os.curdir
+        return None
+
+    def _fold(self):
+        # drift is not verified by a full sync, the next scrub finds it again
+        self.entries.clear()
+        self.parents.clear()
+        self._insert(os.curdir, CHG_DIR | CHG_SUBTREE | CHG_TRANSFER)
+
+#########################################################
+# Class : PathFilter                                    #
+#########################################################
+class PathFilter(object):
+    # The <exclude> and <include> patterns of a sync, in the order they are
+    # passed to rsync, matched the way rsync does: the first matching rule
+    # wins and the contents of an excluded folder are excluded as well.
+    # Results for folders are cached.
+    def __init__(self, sync):
+        self.rules=[]
+        self.cache={}
+        if Common.checkkey(sync,'exclude'):
+            for exclude in sync['exclude'].split(','):
+                self._addRule(False, exclude.strip())
+        if Common.checkkey(sync,'include'):
+            for include in sync['include'].split(','):
+                self._addRule(True, include.strip())
+
+    def __len__(self):
+        return len(self.rules)
+
+    def isIncluded(self, relpath, isdir):
+        if not self.rules or not relpath or relpath == os.curdir:
+            return True
+        parent = os.path.dirname(relpath)
+        if parent and not self._isDirIncluded(parent):
+            return False
+        return self._check(relpath, isdir)
+
+    def _isDirIncluded(self, relpath):
+        if not relpath in self.cache:
+            if len(self.cache) >= FILTER_CACHE:
+                self.cache.clear()
+            parent = os.path.dirname(relpath)
+            self.cache[relpath] = (not parent or self._isDirIncluded(parent)) and self._check(relpath, True)
+        return self.cache[relpath]
+
+    def _check(self, relpath, isdir):
+        name = os.path.basename(relpath)
+        for include, regex, dironly, full in self.rules:
+            if dironly and not isdir:
+                continue
+            if regex.search(relpath if full else name):
+                return include
+        return True
+
+    def _addRule(self, include, pattern):
+        if not pattern:
+            return
+        dironly = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        contents = pattern.endswith('/***')
+        if contents:
+            # matches the folder and everything in it
+            pattern = pattern[:-4]
+            dironly = False
+        anchored = pattern.startswith('/')
+        pattern = pattern.lstrip('/')
+        full = anchored or '/' in pattern or '**' in pattern or contents
+        regex = self._translate(pattern)
+        if contents:
+            regex += '(/.*)?'
+        if anchored:
+            regex = '^' + regex + '$'
+        elif full:
+            regex = '(^|/)' + regex + '$'
+        else:
+            regex = '^' + regex + '$'
+        self.rules.append((include, re.compile(regex, re.DOTALL), dironly, full))
+
+    def _translate(self, pattern):
+        # rsync wildcards: ** also matches /, * and ? don't
+        regex = ''
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**/', i):
+                # also matches no folder at all
+                regex += '(.*/)?'
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+                continue
+            if char == '*':
+                regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            elif char == '[':
+                end = pattern.find(']', i + 2)
+                if end < 0:
+                    regex += re.escape(char)
+                else:
+                    chars = pattern[i+1:end]
+                    if chars[0] in '!^':
+                        chars = '^' + chars[1:]
+                    regex += '[' + chars.replace('\\', '\\\\') + ']'
+                    i = end
+            elif char == '\\' and i + 1 < len(pattern):
+                i += 1
+                regex += re.escape(pattern[i])
+            else:
+                regex += re.escape(char)
+            i += 1
+        return regex
 
 #########################################################
 # Class : rsyncThread                                   #
 #########################################################
 class rsyncThread(Thread):
-    def __init__(self, logger, sync, callback):
+    PROGRESS = re.compile(r'^([\d,.]+)\s+(\d+)%\s+\S+\s+\S+(?:\s+\(xfr#(\d+), \w+-chk=(\d+)/(\d+)\))?')
+    STATS = re.compile(r'^([A-Z][\w ]+): ([\d,.]+)')
+    STATS_KEYS = {"Number of files": "files",
+                  "Number of created files": "created",
+                  "Number of deleted files": "deleted",
+                  "Number of regular files transferred": "transferred",
+                  "Total file size": "totalsize",
+                  "Total transferred file size": "transferredsize",
+                  "Literal data": "literal",
+                  "Matched data": "matched",
+                  "Total bytes sent": "sent",
+                  "Total bytes received": "received"}
+
+    def __init__(self, logger, sync, callback, changes = None, command = None):
         self.sync=sync
         self.logger=logger
         self.callback=callback
+        self.changes=changes
+        self.command=command
+        self.filesfrom=None
+        self.returncode=-1
+        self.stats={}
+        self.progress={}
         Thread.__init__(self)
         self.setDaemon(False)
 
@@ -137,114 +594,1780 @@ class rsyncThread(Thread):
         pass
 
     def run(self):
-        opts=self._rsyncbuildopts()
-        result = run(opts, stdout=PIPE, stderr=PIPE)
-        if result.returncode == 0:
-            if result.stdout.decode("utf-8").strip():
-                self.logger.info("{}: Output:\n{}".format(self.sync['name'],result.stdout.decode("utf-8").strip()))
+        if self._isEmpty():
+            return
+        output=deque(maxlen=OUTPUT_TAIL)
+        errors=deque(maxlen=OUTPUT_TAIL)
+        process=None
+        try:
+            # universal newlines also splits the progress updates on \r
+            process = Popen(self._rsyncbuildopts(), stdout=PIPE, stderr=PIPE, universal_newlines=True, encoding="utf-8", errors="replace")
+            errorThread = Thread(target=self._readErrors, args=(process.stderr, errors))
+            errorThread.start()
+            for line in process.stdout:
+                self._parseLine(line.strip(), output)
+            errorThread.join()
+            self.returncode = process.wait()
+        except Exception as e:
+            # e.g. SYNC_TOOL not executable, the callback is still needed to free the scheduler
+            errors.append(str(e))
+            self.returncode = -1
+            if process and process.poll() == None:
+                process.kill()
+                process.wait()
+        finally:
+            self._removeFilesFrom()
+        self._finish(output, errors)
+
+    def _isEmpty(self):
+        if self.changes != None and not self.changes:
+            self.logger.info("{}: Nothing to synchronize".format(self.sync['name']))
+            self.returncode=0
+            self.callback()
+            return True
+        return False
+
+    def _removeFilesFrom(self):
+        if self.filesfrom:
+            try:
+                os.remove(self.filesfrom)
+            except OSError as e:
+                self.logger.error("{}: Error removing {}: {}".format(self.sync['name'], self.filesfrom, e))
+            self.filesfrom=None
+
+    def _finish(self, output, errors):
+        if self.returncode == 0:
+            self.logger.info("{}: {} of {} files transferred ({} bytes), {} deleted".format(self.sync['name'],
+                    self.stats.get("transferred", 0), self.stats.get("files", 0), self.stats.get("transferredsize", 0), self.stats.get("deleted", 0)))
         else:
-            self.logger.error("{}: Error during syncing: {}".format(self.sync['name'],result.returncode))
-            if result.stdout.decode("utf-8").strip():
-                self.logger.info("{}: Output:\n{}".format(self.sync['name'],result.stdout.decode("utf-8").strip()))
-            if result.stderr.decode("utf-8").strip():
-                self.logger.info("{}: Error:\n{}".format(self.sync['name'],result.stderr.decode("utf-8").strip()))
+            self.logger.error("{}: Error during syncing: {}".format(self.sync['name'],self.returncode))
+            if output:
+                self.logger.info("{}: Output:\n{}".format(self.sync['name'],"\n".join(output)))
+            if errors:
+                self.logger.info("{}: Error:\n{}".format(self.sync['name'],"\n".join(errors)))
         self.callback()
 
-    def _rsyncbuildopts(self):
-        if not Common.checkkey(self.sync,'source') or not Common.checkkey(self.sync,'destination'):
+    def _readErrors(self, stream, errors):
+        for line in stream:
+            if line.strip():
+                errors.append(line.strip())
+
+    def _parseLine(self, line, output):
+        if not line:
+            return
+        progress = self.PROGRESS.match(line)
+        if progress:
+            self.progress["bytes"] = int(progress.group(1).replace(',','').replace('.',''))
+            self.progress["percent"] = int(progress.group(2))
+            if progress.group(3):
+                # file completed
+                self.progress["files"] = int(progress.group(3))
+                self.progress["tocheck"] = int(progress.group(4))
+                self.progress["total"] = int(progress.group(5))
+                self.logger.info("{}: {}".format(self.sync['name'], line))
+            return
+        match = self.STATS.match(line)
+        if match and match.group(1) in self.STATS_KEYS:
+            self.stats[self.STATS_KEYS[match.group(1)]] = int(match.group(2).replace(',','').replace('.',''))
+        else:
+            self.logger.debug("{}: {}".format(self.sync['name'], line))
+        output.append(line)
+
+    @classmethod
+    def getCommand(cls, sync):
+        # rsync and its options, without the paths to transfer
+        if not Common.checkkey(sync,'source') or not Common.checkkey(sync,'destination'):
+            return None
+        tool=Common.which(SYNC_TOOL)
+        if not tool:
+            # looked up again for the next run
             return None
         params=[]
-        params.append(Common.which(SYNC_TOOL))
-        opt="-Pa"
+        params.append(tool)
+        opt="-a"
 
-        if Common.checkkey(self.sync,'compress'):
-            opt=opt+"z"
-        if Common.checkkey(self.sync,'update'):
+        # compression is chosen per run by TransferProfile
+        if Common.checkkey(sync,'update'):
             opt=opt+"u"
         params.append(opt)
-        if Common.checkkey(self.sync,'delete'):
+        params.append("--partial")
+        params.append("--stats")
+        if Common.checkkey(sync,'progress'):
+            params.append("--progress")
+        if Common.checkkey(sync,'delete'):
             params.append("--delete")
-        if Common.checkkey(self.sync,'exclude'):
-            excludes=self.sync['exclude'].split(',')
+        if Common.checkkey(sync,'target'):
+            # the timestamps of the other destinations
+            params.append("--exclude=/{}*".format(TS_FILENAME))
+        if Common.checkkey(sync,'exclude'):
+            excludes=sync['exclude'].split(',')
             excludes.append(TS_FILENAME)
             for exclude in excludes:
                 params.append("--exclude={}".format(exclude.strip()))
-        if Common.checkkey(self.sync,'include'):
-            includes=self.sync['include'].split(',')
+        if Common.checkkey(sync,'include'):
+            includes=sync['include'].split(',')
             for include in includes:
                 params.append("--include={}".format(include.strip()))
-        if Common.checkkey(self.sync,'options'):
-            options=self.sync['options'].split(',')
+        if Common.checkkey(sync,'options'):
+            options=sync['options'].split(',')
             for option in options:
                 params.append("{}".format(option.strip()))
+        return params
+
+    def _rsyncbuildopts(self):
+        if self.command == None:
+            self.command = self.getCommand(self.sync)
+        if self.command == None:
+            raise OSError("{} not found or no source and destination".format(SYNC_TOOL))
+        params=list(self.command)
+        if self.changes != None:
+            params.extend(self._rsyncfilesfrom())
         params.append(os.path.join(self.sync['source'],''))
         params.append(os.path.normpath(self.sync['destination']))
 
-        return params
+        return params
+
+    def _rsyncfilesfrom(self):
+        # Only transfer the changed paths, parents are created by --relative (implied dirs)
+        fd, self.filesfrom = tempfile.mkstemp(prefix="syncwatch-", suffix=".list")
+        with os.fdopen(fd, "wb") as listfile:
+            for path in self.changes:
+                listfile.write(os.fsencode(path) + b"\0")
+        params=[]
+        params.append("--files-from={}".format(self.filesfrom))
+        params.append("--from0")
+        params.append("--relative")
+        # -a doesn't imply -r with --files-from, needed for created or moved in folders
+        params.append("-r")
+        if Common.checkkey(self.sync,'delete'):
+            params.append("--delete-missing-args")
+        else:
+            params.append("--ignore-missing-args")
+        return params
+
+#########################################################
+# Class : rsyncTask                                     #
+#########################################################
+class rsyncTask(rsyncThread):
+    # rsyncThread running rsync as a subprocess on the event loop of an
+    # AsyncEngine instead of in its own thread
+    def __init__(self, logger, sync, callback, changes, command, engine):
+        rsyncThread.__init__(self, logger, sync, callback, changes, command)
+        self.engine=engine
+        self.done=Event()
+        self.done.clear()
+
+    def start(self):
+        self.engine.submit(self._run())
+
+    def is_alive(self):
+        return not self.done.isSet()
+
+    def join(self, timeout = None):
+        self.done.wait(timeout)
+
+    async def _run(self):
+        try:
+            if self._isEmpty():
+                return
+            output=deque(maxlen=OUTPUT_TAIL)
+            errors=deque(maxlen=OUTPUT_TAIL)
+            process=None
+            try:
+                process = await asyncio.create_subprocess_exec(*self._rsyncbuildopts(), stdout=PIPE, stderr=PIPE)
+                errorTask = asyncio.ensure_future(self._readErrorsAsync(process.stderr, errors))
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                pending = ""
+                while True:
+                    data = await process.stdout.read(READ_CHUNK)
+                    # split the progress updates on \r as well
+                    lines = (pending + decoder.decode(data, not data)).replace('\r','\n').split('\n')
+                    pending = lines.pop() if data else ""
+                    for line in lines:
+                        self._parseLine(line.strip(), output)
+                    if not data:
+                        break
+                await errorTask
+                self.returncode = await process.wait()
+            except Exception as e:
+                errors.append(str(e))
+                self.returncode = -1
+                if process and process.returncode == None:
+                    process.kill()
+                    await process.wait()
+            finally:
+                self._removeFilesFrom()
+            self._finish(output, errors)
+        finally:
+            self.done.set()
+
+    async def _readErrorsAsync(self, stream, errors):
+        async for line in stream:
+            line = line.decode("utf-8", errors="replace").strip()
+            if line:
+                errors.append(line)
+
+#########################################################
+# Class : shardThread                                   #
+#########################################################
+class shardThread(rsyncThread):
+    # Full sync split into shards that are synced by concurrent rsyncs. The
+    # root shard syncs the top level without recursion, which also deletes
+    # top level entries that are gone from the source. Every top level
+    # folder is a shard synced like an incremental change, with deletes
+    # inside it. Shards are started largest first (by number of entries).
+    def __init__(self, logger, sync, callback, command, workers):
+        rsyncThread.__init__(self, logger, sync, callback, None, command)
+        self.workers=workers
+        self.failed=[]
+        self.mutex=Lock()
+
+    def run(self):
+        shards = self._getShards()
+        self.logger.info("{}: Synchronizing {} shards with {} workers".format(self.sync['name'], len(shards), self.workers))
+        queue = deque(shards)
+        workers = [Thread(target=self._worker, args=(queue,)) for i in range(min(self.workers, len(shards)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.returncode = 1 if self.failed else 0
+        self._finish(deque(), deque(["Shard {} failed".format(shard) for shard in self.failed]))
+
+    def _getShards(self):
+        shards = []
+        try:
+            with os.scandir(self.sync['source']) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and entry.name != TS_FILENAME:
+                        shards.append((self._getWeight(entry.path), entry.name))
+        except OSError as e:
+            self.logger.error("{}: Error listing source: {}".format(self.sync['name'], e))
+        shards.sort(reverse=True)
+        return [os.curdir] + [name for weight, name in shards]
+
+    def _getWeight(self, path):
+        try:
+            with os.scandir(path) as entries:
+                return sum(1 for entry in entries)
+        except OSError:
+            return 0
+
+    def _worker(self, queue):
+        while True:
+            self.mutex.acquire()
+            shard = queue.popleft() if queue else None
+            self.mutex.release()
+            if shard == None:
+                return
+            sync = dict(self.sync, name="{} [{}]".format(self.sync['name'], shard))
+            rsync = None
+            try:
+                if shard == os.curdir:
+                    rsync = rsyncThread(self.logger, sync, self._shardFinished, None, self.command + ["--no-recursive", "--dirs"])
+                else:
+                    rsync = rsyncThread(self.logger, sync, self._shardFinished, [shard], self.command)
+                rsync.run()
+            except Exception as e:
+                self.logger.error("{}: Error synchronizing shard: {}".format(sync['name'], e))
+            self.mutex.acquire()
+            if rsync:
+                for key, value in rsync.stats.items():
+                    self.stats[key] = self.stats.get(key, 0) + value
+            if not rsync or rsync.returncode != 0:
+                self.failed.append(shard)
+            self.mutex.release()
+
+    def _shardFinished(self):
+        pass
+
+#########################################################
+# Class : verifyThread                                  #
+#########################################################
+class verifyThread(rsyncThread):
+    # Incremental sync with paths found different by the scrub. These are
+    # synced by a second rsync with --checksum, as their size and mtime may
+    # be equal. Newer files on the destination are kept with <update> or
+    # <reversesync>, they may be changes not synced back yet.
+    def __init__(self, logger, sync, callback, changes, command, verified):
+        rsyncThread.__init__(self, logger, sync, callback, changes, command)
+        self.verified=verified
+
+    def run(self):
+        runs = []
+        changes = [relpath for relpath in self.changes if not relpath in self.verified]
+        if changes:
+            runs.append((changes, self.command))
+        command = self.command + ["--checksum"]
+        if Common.checkkey(self.sync,'reversesync') and not Common.checkkey(self.sync,'update'):
+            command.append("--update")
+        runs.append((sorted(self.verified), command))
+        self.returncode = 0
+        for changes, command in runs:
+            rsync = rsyncThread(self.logger, self.sync, self._runFinished, changes, command)
+            rsync.run()
+            for key, value in rsync.stats.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+            if rsync.returncode != 0:
+                self.returncode = rsync.returncode
+        self._finish(deque(), deque())
+
+    def _runFinished(self):
+        pass
+
+#########################################################
+# Class : copyThread                                    #
+#########################################################
+class copyThread(rsyncThread):
+    # Transfers a small incremental change set between local folders
+    # without starting rsync. Files are copied to a temporary name like
+    # rsync does, with their metadata, and renamed into place. Paths missing
+    # in the source are deleted on the destination with <delete>.
+    def __init__(self, logger, sync, callback, changes, verified = None):
+        rsyncThread.__init__(self, logger, sync, callback, changes)
+        self.verified=verified or set()
+
+    @classmethod
+    def canCopy(cls, sync, changes):
+        if not changes or len(changes) > COPY_MAXFILE:
+            return False
+        if Common.checkkey(sync,'localcopy') == False or Common.checkkey(sync,'options'):
+            return False
+        for path in (sync['source'], sync['destination']):
+            if Common.isremote(path) or not os.path.isabs(path):
+                return False
+        size = 0
+        for relpath in changes:
+            try:
+                st = os.lstat(os.path.join(sync['source'], relpath))
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return False
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                # folders are transferred recursively by rsync
+                return False
+            size += st.st_size
+            if size > COPY_MAXSIZE:
+                return False
+        return True
+
+    def run(self):
+        if self._isEmpty():
+            return
+        output=deque(maxlen=OUTPUT_TAIL)
+        errors=deque(maxlen=OUTPUT_TAIL)
+        self.stats={"files":len(self.changes), "transferred":0, "transferredsize":0, "deleted":0}
+        for relpath in self.changes:
+            source = os.path.join(self.sync['source'], relpath)
+            destination = os.path.join(self.sync['destination'], relpath)
+            try:
+                try:
+                    st = os.lstat(source)
+                except FileNotFoundError:
+                    st = None
+                if st:
+                    self._makeParents(relpath)
+                    if self._isUpdated(st, destination, relpath in self.verified):
+                        self._copy(source, destination, st)
+                        self.stats["transferred"] += 1
+                        self.stats["transferredsize"] += st.st_size
+                        output.append(relpath)
+                elif Common.checkkey(self.sync,'delete') and os.path.lexists(destination):
+                    if os.path.isdir(destination) and not os.path.islink(destination):
+                        shutil.rmtree(destination)
+                    else:
+                        os.remove(destination)
+                    self.stats["deleted"] += 1
+                    output.append("deleting {}".format(relpath))
+            except OSError as e:
+                errors.append("{}: {}".format(relpath, e))
+        self.returncode = 1 if errors else 0
+        self._finish(output, errors)
+
+    def _isUpdated(self, st, destination, verify = False):
+        # -u skips files that are newer on the destination, -a files with the same size and mtime.
+        # Drift found by the scrub is copied also with the same size and mtime.
+        try:
+            dst = os.lstat(destination)
+        except FileNotFoundError:
+            return True
+        update = Common.checkkey(self.sync,'update') or (verify and Common.checkkey(self.sync,'reversesync'))
+        if update and dst.st_mtime_ns > st.st_mtime_ns:
+            return False
+        if verify:
+            return True
+        return dst.st_size != st.st_size or dst.st_mtime_ns != st.st_mtime_ns or stat.S_IFMT(dst.st_mode) != stat.S_IFMT(st.st_mode)
+
+    def _makeParents(self, relpath):
+        parents = []
+        parent = os.path.dirname(relpath)
+        while parent and not os.path.isdir(os.path.join(self.sync['destination'], parent)):
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+        for parent in parents:
+            source = os.path.join(self.sync['source'], parent)
+            destination = os.path.join(self.sync['destination'], parent)
+            os.mkdir(destination)
+            self._copyOwner(os.lstat(source), destination)
+            shutil.copystat(source, destination)
+
+    def _copy(self, source, destination, st):
+        folder, name = os.path.split(destination)
+        tmppath = None
+        try:
+            if stat.S_ISLNK(st.st_mode):
+                tmppath = self._makeLink(os.readlink(source), folder, name)
+            else:
+                fd, tmppath = tempfile.mkstemp(prefix="." + name + ".", dir=folder)
+                with open(source, "rb") as src_file, os.fdopen(fd, "wb") as dst_file:
+                    self._copyData(src_file, dst_file, st.st_size)
+            self._copyOwner(st, tmppath)
+            shutil.copystat(source, tmppath, follow_symlinks=False)
+            os.replace(tmppath, destination)
+        except BaseException:
+            if tmppath and os.path.lexists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def _makeLink(self, target, folder, name):
+        # symlink doesn't replace an existing path, so a taken name is tried again
+        while True:
+            tmppath = os.path.join(folder, ".{}.{}".format(name, os.urandom(4).hex()))
+            try:
+                os.symlink(target, tmppath)
+                return tmppath
+            except FileExistsError:
+                continue
+
+    def _copyData(self, src_file, dst_file, size):
+        src = src_file.fileno()
+        dst = dst_file.fileno()
+        copied = 0
+        try:
+            # in kernel copy, reflinks on file systems that support it
+            while True:
+                count = os.copy_file_range(src, dst, max(size - copied, READ_CHUNK))
+                if not count:
+                    return
+                copied += count
+        except (AttributeError, OSError):
+            if copied:
+                raise
+        try:
+            while True:
+                count = os.sendfile(dst, src, copied, max(size - copied, READ_CHUNK))
+                if not count:
+                    return
+                copied += count
+        except OSError:
+            if copied:
+                raise
+        shutil.copyfileobj(src_file, dst_file, READ_CHUNK)
+
+    def _copyOwner(self, st, path):
+        try:
+            os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+        except PermissionError:
+            # only root preserves the owner, like rsync
+            pass
+
+#########################################################
+# Class : ThreadEngine                                  #
+#########################################################
+class ThreadEngine(object):
+    # Runs every timer and every rsync in its own thread
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def callLater(self, delay, callback):
+        timer = Timer(delay, callback)
+        timer.start()
+        return timer
+
+    def wait(self, event, callback):
+        event.wait()
+        callback()
+
+    def rsync(self, logger, sync, callback, changes, command):
+        return rsyncThread(logger, sync, callback, changes, command)
+
+#########################################################
+# Class : AsyncTimer                                    #
+#########################################################
+class AsyncTimer(object):
+    # Timer handle for a callback on the event loop, may be cancelled from any thread
+    def __init__(self, loop, delay, callback):
+        self.loop=loop
+        self.callback=callback
+        self.handle=None
+        self.cancelled=False
+        self.loop.call_soon_threadsafe(self._arm, delay)
+
+    def cancel(self):
+        self.cancelled=True
+        if self.handle and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.handle.cancel)
+
+    def _arm(self, delay):
+        if not self.cancelled:
+            self.handle=self.loop.call_later(delay, self._run)
+
+    def _run(self):
+        if not self.cancelled:
+            self.callback()
+
+#########################################################
+# Class : AsyncEngine                                   #
+#########################################################
+class AsyncEngine(object):
+    # Runs all timers and rsync processes on one asyncio event loop, in one
+    # thread. Callbacks on the loop must not block, waits are rescheduled.
+    def __init__(self, logger):
+        self.logger=logger
+        self.loop=asyncio.new_event_loop()
+        self.thread=Thread(target=self._run)
+        self.thread.daemon=True
+        self.tasks=set()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # running rsyncs are finished first
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def callLater(self, delay, callback):
+        return AsyncTimer(self.loop, delay, callback)
+
+    def wait(self, event, callback):
+        if event.isSet():
+            callback()
+        else:
+            self.callLater(SYNC_WAIT, lambda: self.wait(event, callback))
+
+    def submit(self, coroutine):
+        self.loop.call_soon_threadsafe(self._addTask, coroutine)
+
+    def rsync(self, logger, sync, callback, changes, command):
+        return rsyncTask(logger, sync, callback, changes, command, self)
+
+    def _addTask(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self):
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        if sys.version_info < (3, 12) and hasattr(asyncio, "PidfdChildWatcher"):
+            # the default child watcher starts a thread per process
+            try:
+                watcher = asyncio.PidfdChildWatcher()
+                watcher.attach_loop(self.loop)
+                asyncio.set_child_watcher(watcher)
+            except Exception as e:
+                self.logger.debug("Pidfd child watcher not available: {}".format(e))
+        self.loop.run_forever()
+        self.loop.close()
+
+#########################################################
+# Class : TransferProfile                               #
+#########################################################
+class TransferProfile(object):
+    # rsync options chosen per run. Changed files of <largefile> MB or more
+    # are written in place with the delta algorithm, instead of to a full
+    # temporary copy. <profile> forces a profile for every run. Compression
+    # is only used for remote locations and not for runs of only
+    # compressed files.
+    PROFILES = {"whole": ["--whole-file"],
+                "delta": ["--no-whole-file"],
+                "inplace": ["--inplace", "--no-whole-file"],
+                "append": ["--append-verify"]}
+
+    def __init__(self, logger, sync):
+        self.logger=logger
+        self.sync=sync
+        self.remote=Common.isremote(sync['source']) or Common.isremote(sync['destination'])
+        self.profile=Common.checkkey(sync,'profile')
+        if self.profile and not self.profile in self.PROFILES:
+            self.logger.error("{}: Unknown profile {}, using automatic profile".format(sync['name'], self.profile))
+            self.profile=None
+        self.largefile=Common.checkkey(sync,'largefile')
+        if not self.largefile:
+            self.largefile=LARGE_FILE
+        self.largefile*=1024*1024
+
+    def getOptions(self, changes):
+        options=[]
+        if Common.checkkey(self.sync,'compress') and self.remote and not self._isCompressed(changes):
+            options.append("-z")
+        profile=self.profile
+        if not profile and self._hasLarge(changes):
+            profile="inplace"
+        if profile:
+            options.extend(self.PROFILES[profile])
+        return options
+
+    def _isCompressed(self, changes):
+        if not changes:
+            return False
+        for relpath in changes:
+            if not os.path.splitext(relpath)[1][1:].lower() in NOCOMPRESS:
+                return False
+        return True
+
+    def _hasLarge(self, changes):
+        # sizes are unknown for a full sync
+        if not changes:
+            return False
+        for relpath in changes[:LARGE_CHECK]:
+            try:
+                if os.stat(os.path.join(self.sync['source'], relpath)).st_size >= self.largefile:
+                    return True
+            except OSError:
+                pass
+        return False
+
+#########################################################
+# Class : BandwidthSchedule                             #
+#########################################################
+class BandwidthSchedule(object):
+    # Bandwidth limit in KB/s by time of day, from "<limit>" or
+    # "<from>-<to>=<limit>, ..., <limit>" with times as HH:MM. The first
+    # window containing the current time applies, otherwise the entry
+    # without window, otherwise there is no limit. A window may pass
+    # midnight, a limit of 0 holds the syncs until the window ends.
+    def __init__(self, logger, name, spec):
+        self.logger=logger
+        self.name=name
+        self.windows=[]
+        self.default=None
+        if spec != None:
+            self._parse(spec)
+
+    def __bool__(self):
+        return bool(self.windows) or self.default != None
+
+    def getLimit(self, now = None):
+        if now == None:
+            now = time.time()
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, limit in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return limit
+            elif minute >= start or minute < end:
+                return limit
+        return self.default
+
+    def _parse(self, spec):
+        if isinstance(spec, (int, float)) and not isinstance(spec, bool):
+            self.default=int(spec)
+            return
+        for entry in str(spec).split(','):
+            try:
+                if '=' in entry:
+                    window, limit = entry.split('=', 1)
+                    start, end = window.split('-', 1)
+                    self.windows.append((self._getMinute(start), self._getMinute(end), int(limit)))
+                else:
+                    self.default=int(entry)
+            except ValueError:
+                self.logger.error("{}: Invalid bandwidth limit {}, ignored".format(self.name, entry.strip()))
+
+    def _getMinute(self, text):
+        hours, minutes = text.strip().split(':', 1)
+        minute = int(hours) * 60 + int(minutes)
+        if minute < 0 or minute > 24 * 60:
+            raise ValueError
+        return minute
+
+#########################################################
+# Class : ProcessPriority                               #
+#########################################################
+class ProcessPriority(object):
+    # CPU and I/O priority of the rsync children, started through nice and
+    # ionice. <nice> is the niceness (-20 to 19), <ionice> the class (idle,
+    # besteffort or realtime) with an optional level, as besteffort:7.
+    # Settings of the sync override the global settings.
+    def __init__(self, logger, sync, defaults):
+        self.logger=logger
+        self.name=sync['name']
+        self.nice=Common.checkkey(sync,'nice')
+        if self.nice == None:
+            self.nice=Common.checkkey(defaults,'nice')
+        self.ionice=Common.checkkey(sync,'ionice')
+        if self.ionice == None:
+            self.ionice=Common.checkkey(defaults,'ionice')
+
+    def getPrefix(self):
+        prefix=[]
+        if self.ionice:
+            prefix.extend(self._getIonice())
+        if self.nice:
+            tool=Common.which(NICE_TOOL)
+            if tool:
+                prefix.extend([tool, "-n", str(self.nice)])
+            else:
+                self.logger.warning("{}: {} not found, running with normal CPU priority".format(self.name, NICE_TOOL))
+        return prefix
+
+    def _getIonice(self):
+        spec=str(self.ionice).lower().split(':')
+        if not spec[0] in IONICE_CLASS:
+            self.logger.error("{}: Unknown I/O class {}, running with normal I/O priority".format(self.name, self.ionice))
+            return []
+        tool=Common.which(IONICE_TOOL)
+        if not tool:
+            self.logger.warning("{}: {} not found, running with normal I/O priority".format(self.name, IONICE_TOOL))
+            return []
+        prefix=[tool, "-c", str(IONICE_CLASS[spec[0]])]
+        # the idle class has no levels
+        if len(spec) > 1 and spec[0] != "idle":
+            if spec[1].isdigit():
+                prefix.extend(["-n", spec[1]])
+            else:
+                self.logger.error("{}: Invalid I/O level {}, using the default level".format(self.name, spec[1]))
+        return prefix
+
+#########################################################
+# Class : ChangeJournal                                 #
+#########################################################
+class ChangeJournal(object):
+    # Append-only journal of the pending changes of a sync, replayed at start
+    # and compacted after every successful sync. The first record is the
+    # root, the others are the flags (2 hex digits) and relative path of a
+    # changed entry. Records end with \0, a record cut off by a crash is
+    # ignored.
+    def __init__(self, logger, path, root):
+        self.logger=logger
+        self.path=path
+        self.root=os.fsencode(os.path.normpath(root))
+        self.file=None
+
+    def __del__(self):
+        self.close()
+
+    def load(self):
+        records=[]
+        try:
+            with open(self.path, "rb") as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return records
+        except Exception as e:
+            self.logger.error("Error reading journal {}: {}".format(self.path, e))
+            return [(os.curdir, 0)]
+        parts = data.split(b"\0")[:-1]
+        if parts and parts[0] != b"R" + self.root:
+            self.logger.info("Journal {} is for another location, ignored".format(self.path))
+            return records
+        for part in parts[1:]:
+            try:
+                records.append((os.fsdecode(part[2:]), int(part[:2], 16)))
+            except ValueError:
+                self.logger.error("Journal {} is corrupt, full synchronization needed".format(self.path))
+                records.append((os.curdir, 0))
+        return records
+
+    def append(self, relpath, flags):
+        try:
+            if not self.file:
+                self.file = open(self.path, "ab")
+            self.file.write(b"%02x" % flags + os.fsencode(relpath) + b"\0")
+            self.file.flush()
+        except Exception as e:
+            self.logger.error("Error writing journal {}: {}".format(self.path, e))
+
+    def compact(self, entries):
+        tmppath = self.path + ".tmp"
+        try:
+            with open(tmppath, "wb") as journal_file:
+                journal_file.write(b"R" + self.root + b"\0")
+                for relpath, entry in entries.items():
+                    journal_file.write(b"%02x" % entry[0] + os.fsencode(relpath) + b"\0")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(tmppath, self.path)
+            if self.file:
+                self.file.close()
+                self.file = None
+        except Exception as e:
+            self.logger.error("Error writing journal {}: {}".format(self.path, e))
+
+    def sync(self):
+        if self.file:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+#########################################################
+# Class : HashCache                                     #
+#########################################################
+class HashCache(object):
+    # Content hashes of the files of a location by relative path, with the
+    # inode, size and mtime they were computed for. A file is only read again
+    # when one of these changed. Saved as a root record followed by records
+    # "<inode> <size> <mtime_ns> <hash> <relpath>", all ending with \0.
+    # Entries not used since the last save are dropped.
+    def __init__(self, logger, path, root):
+        self.logger=logger
+        self.path=path
+        self.root=os.fsencode(os.path.normpath(root))
+        self.entries={}
+        self.used={}
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "rb") as cache_file:
+                data = cache_file.read()
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error("Error reading hash cache {}: {}".format(self.path, e))
+            return
+        parts = data.split(b"\0")[:-1]
+        if not parts or parts[0] != b"R" + self.root:
+            return
+        try:
+            for part in parts[1:]:
+                inode, size, mtime, digest, relpath = part.split(b" ", 4)
+                self.entries[os.fsdecode(relpath)] = (int(inode), int(size), int(mtime), bytes.fromhex(digest.decode()))
+        except ValueError:
+            self.logger.error("Hash cache {} is corrupt, files are hashed again".format(self.path))
+            self.entries = {}
+
+    def get(self, relpath, st):
+        entry = self.entries.get(relpath)
+        if entry and entry[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+            self.used[relpath] = entry
+            return entry[3]
+        return None
+
+    def put(self, relpath, st, digest):
+        self.used[relpath] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+
+    def save(self):
+        self.entries = self.used
+        self.used = {}
+        if not self.path:
+            return
+        tmppath = self.path + ".tmp"
+        try:
+            with open(tmppath, "wb") as cache_file:
+                cache_file.write(b"R" + self.root + b"\0")
+                for relpath, entry in self.entries.items():
+                    cache_file.write(b"%d %d %d %s " % (entry[0], entry[1], entry[2], entry[3].hex().encode()) + os.fsencode(relpath) + b"\0")
+            os.replace(tmppath, self.path)
+        except Exception as e:
+            self.logger.error("Error writing hash cache {}: {}".format(self.path, e))
+
+#########################################################
+# Class : DirSnapshot                                   #
+#########################################################
+class DirSnapshot(object):
+    # Inode, size and mtime of every file and folder of a location, to find
+    # the changes made while it was not watched. Saved as a root record
+    # ending with \0, followed by packed records (RECORD) with the length of
+    # the relative path that follows them. The location is read by
+    # SNAP_WORKERS threads, one folder at a time.
+    RECORD = struct.Struct("<QQqBH")
+
+    def __init__(self, logger, path, sync):
+        self.logger=logger
+        self.path=path
+        self.sync=sync
+        self.root=os.path.normpath(sync['source'])
+        self.complete=True
+
+    def load(self):
+        # returns the entries by relative path, None without a usable snapshot
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.error("Error reading snapshot {}: {}".format(self.path, e))
+            return None
+        header = b"R" + os.fsencode(self.root) + b"\0"
+        if not data.startswith(header):
+            self.logger.info("Snapshot {} is for another location, ignored".format(self.path))
+            return None
+        entries = {}
+        offset = len(header)
+        try:
+            while offset < len(data):
+                inode, size, mtime, isdir, length = self.RECORD.unpack_from(data, offset)
+                offset += self.RECORD.size
+                if offset + length > len(data):
+                    raise ValueError("record cut off")
+                entries[os.fsdecode(data[offset:offset + length])] = (inode, size, mtime, isdir)
+                offset += length
+        except (struct.error, ValueError):
+            self.logger.error("Snapshot {} is corrupt, ignored".format(self.path))
+            return None
+        return entries
+
+    def save(self, entries):
+        tmppath = self.path + ".tmp"
+        try:
+            with open(tmppath, "wb") as snapshot_file:
+                snapshot_file.write(b"R" + os.fsencode(self.root) + b"\0")
+                for relpath, entry in entries.items():
+                    path = os.fsencode(relpath)
+                    snapshot_file.write(self.RECORD.pack(entry[0], entry[1], entry[2], entry[3], len(path)) + path)
+            os.replace(tmppath, self.path)
+        except Exception as e:
+            self.logger.error("Error writing snapshot {}: {}".format(self.path, e))
+
+    def scan(self):
+        # returns the entries of the location, complete is False when folders could not be read
+        self.complete = True
+        folders = queue.Queue()
+        folders.put(os.curdir)
+        results = [{} for i in range(SNAP_WORKERS)]
+        workers = [Thread(target=self._worker, args=(folders, result)) for result in results]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        folders.join()
+        for worker in workers:
+            folders.put(None)
+        for worker in workers:
+            worker.join()
+        entries = {}
+        for result in results:
+            entries.update(result)
+        return entries
+
+    def diff(self, old, new):
+        # returns the changes as (relpath, isdir, evtype), without the contents
+        # of created and deleted folders as they are synced with their folder
+        changes = []
+        for relpath, entry in new.items():
+            oldentry = old.get(relpath)
+            if oldentry == None:
+                parent = os.path.dirname(relpath)
+                if not parent or parent in old:
+                    changes.append((relpath, entry[3], "created"))
+            elif oldentry[3] != entry[3]:
+                changes.append((relpath, oldentry[3], "deleted"))
+                changes.append((relpath, entry[3], "created"))
+            elif not entry[3] and oldentry[:3] != entry[:3]:
+                changes.append((relpath, False, "modified"))
+        for relpath, entry in old.items():
+            if not relpath in new:
+                parent = os.path.dirname(relpath)
+                if not parent or parent in new:
+                    changes.append((relpath, entry[3], "deleted"))
+        return changes
+
+    def _worker(self, folders, entries):
+        # the filter caches folders, so every worker has its own
+        pathfilter = PathFilter(self.sync)
+        while True:
+            relpath = folders.get()
+            if relpath == None:
+                folders.task_done()
+                return
+            try:
+                with os.scandir(os.path.join(self.root, relpath)) as scanner:
+                    for entry in scanner:
+                        if entry.name.startswith(TS_FILENAME):
+                            continue
+                        child = os.path.normpath(os.path.join(relpath, entry.name))
+                        st = entry.stat(follow_symlinks=False)
+                        isdir = stat.S_ISDIR(st.st_mode)
+                        if not pathfilter.isIncluded(child, isdir):
+                            continue
+                        entries[child] = (st.st_ino, st.st_size, st.st_mtime_ns, isdir)
+                        if isdir:
+                            folders.put(child)
+            except OSError as e:
+                self.logger.error("Error reading {} for snapshot: {}".format(os.path.join(self.root, relpath), e))
+                self.complete = False
+            folders.task_done()
+
+#########################################################
+# Class : SyncMetrics                                   #
+#########################################################
+class SyncMetrics(object):
+    # Counters, gauges and summaries (sum and count) per sync in the
+    # prometheus text format, written to a textfile and/ or served on
+    # http://localhost:<port>/metrics
+    METRICS = {"events_total": ("counter", "Filesystem events detected"),
+               "events_ignored_total": ("counter", "Events ignored as caused by the reverse sync"),
+               "events_excluded_total": ("counter", "Events dropped by the exclude and include patterns"),
+               "debounce_seconds": ("summary", "Time between arming the sync timer and its timeout"),
+               "latency_seconds": ("summary", "Time between the first event and the completed sync"),
+               "sync_wait_seconds": ("summary", "Time a sync waited on the scheduler"),
+               "sync_duration_seconds": ("summary", "Duration of rsync runs"),
+               "sync_errors_total": ("counter", "Failed rsync runs"),
+               "sync_files_total": ("counter", "Files transferred"),
+               "sync_bytes_total": ("counter", "Bytes of files transferred"),
+               "scrub_drift_total": ("counter", "Paths found different by the scrub"),
+               "scrub_duration_seconds": ("summary", "Duration of scrubs"),
+               "timestamp_mismatch": ("gauge", "Timestamp files of source and destination don't match"),
+               "watches": ("gauge", "Folders watched"),
+               "startup_seconds": ("gauge", "Time to set up the watch and check the snapshot"),
+               "syncs_running": ("gauge", "Syncs running"),
+               "syncs_queued": ("gauge", "Syncs waiting to be started"),
+               "syncs_deferred": ("gauge", "Waiting syncs held by the bandwidth limits")}
+
+    def __init__(self, logger, metricsfile, metricsport):
+        self.logger=logger
+        self.metricsfile=metricsfile
+        self.values={}
+        self.mutex=Lock()
+        self.server=None
+        if metricsport:
+            try:
+                self.server = ThreadingHTTPServer(("localhost", metricsport), MetricsRequestHandler)
+                self.server.metrics = self
+                self.server.daemon_threads = True
+                serverThread = Thread(target=self.server.serve_forever)
+                serverThread.daemon = True
+                serverThread.start()
+                self.logger.info("Metrics available on http://localhost:{}/metrics".format(metricsport))
+            except Exception as e:
+                self.logger.error("Error starting metrics server on port {}: {}".format(metricsport, e))
+                self.server=None
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.write()
+
+    def inc(self, name, job, value = 1, **labels):
+        key=self._getKey(name, job, labels)
+        self.mutex.acquire()
+        self.values[key]=self.values.get(key, 0) + value
+        self.mutex.release()
+
+    def set(self, name, job, value, **labels):
+        key=self._getKey(name, job, labels)
+        self.mutex.acquire()
+        self.values[key]=value
+        self.mutex.release()
+
+    def observe(self, name, job, value):
+        self.inc(name+"_sum", job, value)
+        self.inc(name+"_count", job)
+
+    def render(self):
+        lines=[]
+        self.mutex.acquire()
+        values=sorted(self.values.items())
+        self.mutex.release()
+        for name, (mtype, mhelp) in self.METRICS.items():
+            lines.append("# HELP syncwatch_{} {}".format(name, mhelp))
+            lines.append("# TYPE syncwatch_{} {}".format(name, mtype))
+            for (key, labels), value in values:
+                if key == name or (mtype == "summary" and key in (name+"_sum", name+"_count")):
+                    if labels:
+                        lines.append("syncwatch_{}{{{}}} {}".format(key, ",".join('{}="{}"'.format(label, self._escape(lvalue)) for label, lvalue in labels), value))
+                    else:
+                        lines.append("syncwatch_{} {}".format(key, value))
+        return "\n".join(lines)+"\n"
+
+    def write(self):
+        if self.metricsfile:
+            try:
+                tmpfile = self.metricsfile + ".tmp"
+                with open(tmpfile, "w") as metrics_file:
+                    metrics_file.write(self.render())
+                os.replace(tmpfile, self.metricsfile)
+            except Exception as e:
+                self.logger.error("Error writing metrics file {}: {}".format(self.metricsfile, e))
+
+    def _getKey(self, name, job, labels):
+        if job:
+            labels["job"]=job
+        return (name, tuple(sorted(labels.items())))
+
+    def _escape(self, value):
+        return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+#########################################################
+# Class : MetricsRequestHandler                         #
+#########################################################
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+#########################################################
+# Class : SyncScheduler                                 #
+#########################################################
+class SyncScheduler(object):
+    # Starts all synchronizations, limiting the number of concurrent syncs in
+    # total and per device. Waiting syncs are started by priority, a sync
+    # gains one priority level per PRIO_AGING seconds of waiting. Every
+    # started sync gets a share of the free global bandwidth, a sync is held
+    # in the queue while no bandwidth is free or its own limit is 0.
+    def __init__(self, logger, metrics, maxsyncs, maxdevicesyncs, bandwidth = None, settings = None):
+        self.logger=logger
+        self.metrics=metrics
+        self.maxsyncs=maxsyncs
+        self.maxdevicesyncs=maxdevicesyncs
+        self.bandwidth=bandwidth
+        self.settings=settings if settings != None else {}
+        self.queue=[]
+        self.running=[]
+        self.deferred=[]
+        self.rates={}
+        self.devices={}
+        self.waittimes={}
+        self.mutex=Lock()
+
+    def setLimits(self, maxsyncs, maxdevicesyncs, bandwidth = None, settings = None):
+        self.mutex.acquire()
+        self.maxsyncs=maxsyncs
+        self.maxdevicesyncs=maxdevicesyncs
+        self.bandwidth=bandwidth
+        self.settings=settings if settings != None else {}
+        started = self._launch()
+        self._setGauges()
+        self.mutex.release()
+        self._start(started)
+
+    def submit(self, job):
+        started = []
+        self.mutex.acquire()
+        if not job in self.running and not job in [queued[0] for queued in self.queue]:
+            self.queue.append((job, time.time()))
+            started = self._launch()
+            if job in [queued[0] for queued in self.queue]:
+                self.logger.info("{}: Synchronization queued, {} running, {} waiting".format(job.sync['name'], len(self.running), len(self.queue)))
+            self._setGauges()
+        self.mutex.release()
+        self._start(started)
+
+    def release(self, job):
+        self.mutex.acquire()
+        if job in self.running:
+            self.running.remove(job)
+            self.rates.pop(job, None)
+            for device in job.getDevices():
+                self.devices[device]-=1
+        started = self._launch()
+        self._setGauges()
+        self.mutex.release()
+        self._start(started)
+
+    def cancel(self, job):
+        self.mutex.acquire()
+        self.queue=[queued for queued in self.queue if queued[0] != job]
+        if job in self.deferred:
+            self.deferred.remove(job)
+        self._setGauges()
+        self.mutex.release()
+
+    def poll(self):
+        # bandwidth windows change without a sync finishing
+        started = []
+        self.mutex.acquire()
+        if self.deferred:
+            started = self._launch()
+            self._setGauges()
+        self.mutex.release()
+        self._start(started)
+
+    def getStats(self):
+        self.mutex.acquire()
+        now = time.time()
+        stats = {"running":len(self.running), "queued":len(self.queue), "jobs":{}}
+        for name, waittime in self.waittimes.items():
+            stats["jobs"][name]=waittime.copy()
+        for job, queuedtime in self.queue:
+            if not job.sync['name'] in stats["jobs"]:
+                stats["jobs"][job.sync['name']]={"last":0, "max":0, "total":0, "count":0}
+            stats["jobs"][job.sync['name']]["waiting"]=now - queuedtime
+        self.mutex.release()
+        return stats
+
+    def _launch(self):
+        # takes the slots of the syncs to start, they are started by _start without the lock
+        started = []
+        while self.queue and (not self.maxsyncs or len(self.running) < self.maxsyncs):
+            now = time.time()
+            best = None
+            ready = 0
+            for queued in self.queue:
+                if self._devicesFree(queued[0]) and not self._isDeferred(queued[0], now):
+                    ready += 1
+                    prio = self._getPriority(queued, now)
+                    if not best or prio > best[1]:
+                        best = (queued, prio)
+            if not best:
+                break
+            job, queuedtime = best[0]
+            self.queue.remove(best[0])
+            if job in self.deferred:
+                self.deferred.remove(job)
+            if self.maxsyncs:
+                ready = min(ready, self.maxsyncs - len(self.running))
+            job.bwlimit = self._getRate(job, ready, now)
+            self.rates[job] = job.bwlimit
+            self.running.append(job)
+            for device in job.getDevices():
+                self.devices[device]=self.devices.get(device, 0) + 1
+            self._addWaitTime(job.sync['name'], now - queuedtime)
+            started.append(job)
+        return started
+
+    def _start(self, jobs):
+        for job in jobs:
+            try:
+                job.runSync()
+            except Exception as e:
+                self.logger.error("{}: Error starting synchronization: {}".format(job.sync['name'], e))
+                self.release(job)
+                job.startFailed()
+
+    def _devicesFree(self, job):
+        free = True
+        if self.maxdevicesyncs:
+            for device in job.getDevices():
+                if self.devices.get(device, 0) >= self.maxdevicesyncs:
+                    free = False
+        return free
+
+    def _isDeferred(self, job, now):
+        deferred = job.bandwidth.getLimit(now) == 0
+        if not deferred and self.bandwidth:
+            total = self.bandwidth.getLimit(now)
+            deferred = total != None and self._getFree(total) < BW_MIN
+        if deferred and not job in self.deferred:
+            self.logger.info("{}: Synchronization deferred, no bandwidth left".format(job.sync['name']))
+            self.deferred.append(job)
+        elif not deferred and job in self.deferred:
+            self.deferred.remove(job)
+        return deferred
+
+    def _getFree(self, total):
+        return total - sum([rate for rate in self.rates.values() if rate])
+
+    def _getRate(self, job, ready, now):
+        # share the free bandwidth with the other syncs ready to start
+        rate = job.bandwidth.getLimit(now)
+        if self.bandwidth:
+            total = self.bandwidth.getLimit(now)
+            if total != None:
+                share = max(self._getFree(total) // max(ready, 1), BW_MIN)
+                rate = share if rate == None else min(rate, share)
+        return rate
+
+    def _getPriority(self, queued, now):
+        priority = Common.checkkey(queued[0].sync,'priority')
+        if not priority:
+            priority = 0
+        return priority + (now - queued[1]) / PRIO_AGING
+
+    def _setGauges(self):
+        self.metrics.set("syncs_running", None, len(self.running))
+        self.metrics.set("syncs_queued", None, len(self.queue))
+        self.metrics.set("syncs_deferred", None, len(self.deferred))
+
+    def _addWaitTime(self, name, waittime):
+        self.metrics.observe("sync_wait_seconds", name, waittime)
+        if not name in self.waittimes:
+            self.waittimes[name]={"last":0, "max":0, "total":0, "count":0}
+        self.waittimes[name]["last"]=waittime
+        self.waittimes[name]["max"]=max(self.waittimes[name]["max"], waittime)
+        self.waittimes[name]["total"]+=waittime
+        self.waittimes[name]["count"]+=1
 
 #########################################################
 # Class : rsync                                         #
 #########################################################
 class rsync(object):
-    def __init__(self, logger, sync, callback = None):
+    def __init__(self, logger, sync, scheduler, metrics, engine, callback = None):
         self.sync=sync
         self.logger=logger
+        self.scheduler=scheduler
+        self.metrics=metrics
+        self.engine=engine
         self.callback = callback
         self.syncThread=None
+        self.command=None
+        self.profile=TransferProfile(logger, sync)
+        self.changes=None
+        self.verified=set()
+        self.bandwidth=BandwidthSchedule(logger, sync['name'], Common.checkkey(sync,'bwlimit'))
+        self.bwlimit=None
+        self.copyfailed=False
+        self.busy=False
+        self.idle=Event()
+        self.idle.set()
+        self.previous=None
+        self.retrydelay=0
+        self.eventtime=None
+        self.starttime=0
+        self.devices=None
         self.waitsync=Event()
         self.waitsync.clear()
         self.sync['1'].set()
 
     def __del__(self):
+        self.cancel()
         if self.syncThread:
             self.syncThread.join()
         del self.waitsync
-        del self.sync['1']
+
+    def cancel(self):
+        # drops a waiting sync, a running sync is finished
+        self.scheduler.cancel(self)
+        self.waitsync.clear()
+        if not self.busy:
+            self._releasePair(False)
+            self.sync['1'].set()
 
     def __call__(self):
-        if self.syncThread:
-            if self.syncThread.isAlive():
-                self.waitsync.set()
-                return
+        if self.busy:
+            self.waitsync.set()
+            return
         self._startSync()
         return
 
+    def getDevices(self):
+        if self.devices == None:
+            self.devices = []
+            for path in (self.sync['source'], self.sync['destination']):
+                try:
+                    device = os.stat(path).st_dev
+                except:
+                    # remote location
+                    device = path.split(':')[0]
+                if not device in self.devices:
+                    self.devices.append(device)
+        return self.devices
+
+    def runSync(self):
+        self.busy=True
+        self.idle.clear()
+        self.sync['list1'].syncJournal()
+        self.starttime=time.time()
+        self.eventtime=self.sync['eventtime']
+        self.sync['eventtime']=None
+        changes=self._getChanges()
+        self.changes=changes
+        self.verified=set()
+        if changes != None:
+            self.verified=self.sync['list1'].getVerified(self.sync['listsent'])
+        if self.command == None:
+            # resolved once per job
+            self.command = rsyncThread.getCommand(self.sync)
+        if self.command == None:
+            # also for a local copy, its changes are kept by startFailed
+            raise OSError("{} not found or no source and destination".format(SYNC_TOOL))
+        if changes == None:
+            self.logger.info("{}: Synchronization started".format(self.sync['name']))
+            if Common.checkkey(self.sync,'shards') and self.sync['shards'] > 1:
+                self.syncThread = shardThread(self.logger, self.sync, self._Callback, self._getCommand(changes, self.sync['shards']), self.sync['shards'])
+                self.syncThread.start()
+                return
+        elif not self.copyfailed and copyThread.canCopy(self.sync, changes):
+            self.logger.info("{}: Local copy started ({} changes)".format(self.sync['name'], len(changes)))
+            self.syncThread = copyThread(self.logger, self.sync, self._Callback, changes, self.verified)
+            self.syncThread.start()
+            return
+        elif self.verified:
+            self.logger.info("{}: Incremental synchronization started ({} changes, {} by checksum)".format(self.sync['name'], len(changes), len(self.verified)))
+            self.syncThread = verifyThread(self.logger, self.sync, self._Callback, changes, self._getCommand(changes), self.verified)
+            self.syncThread.start()
+            return
+        else:
+            self.logger.info("{}: Incremental synchronization started ({} changes)".format(self.sync['name'], len(changes)))
+        self.syncThread = self.engine.rsync(self.logger, self.sync, self._Callback, changes, self._getCommand(changes))
+        self.syncThread.start()
+
+    def startFailed(self):
+        # runSync raised, the changes are kept and retried with a delay
+        # doubling from RETRY_DELAY up to RETRY_MAX
+        self.busy=False
+        if self.eventtime and not self.sync['eventtime']:
+            self.sync['eventtime']=self.eventtime
+        self._releasePair(False)
+        self.sync['1'].set()
+        self.idle.set()
+        self.retrydelay = min(self.retrydelay * 2, RETRY_MAX) if self.retrydelay else RETRY_DELAY
+        if self.sync['handler']:
+            self.logger.info("{}: Changes kept, retrying in {} seconds".format(self.sync['name'], self.retrydelay))
+            self.sync['handler'].timer.retry(self.retrydelay)
+
+    def _getCommand(self, changes, workers = 1):
+        # options chosen per run, the bandwidth is shared by the workers
+        if self.command == None:
+            return None
+        command = ProcessPriority(self.logger, self.sync, self.scheduler.settings).getPrefix() + self.command + self.profile.getOptions(changes)
+        if self.bwlimit:
+            rate = max(self.bwlimit // workers, 1)
+            self.logger.info("{}: Bandwidth limited to {} KB/s".format(self.sync['name'], self.bwlimit))
+            command.append("--bwlimit={}".format(rate))
+        return command
+
     def _startSync(self):
+        if self.previous and not self.previous.idle.isSet():
+            # the job of a stopped watch may still be writing to the destination
+            self.logger.info("{}: Waiting on previous synchronization to finish".format(self.sync['name']))
+            self.engine.wait(self.previous.idle, self._startSync)
+            return
+        self.previous=None
+        if Common.checkkey(self.sync,'pair') and not self.sync['pair'].claim(self.sync):
+            self.logger.info("{}: Waiting on reverse action to finish".format(self.sync['name']))
+            self.engine.wait(self.sync['2'], self._startSync)
+            return
         self.sync['1'].clear()
-        self.logger.info("{}: Synchronization started".format(self.sync['name']))
-        self.syncThread = rsyncThread(self.logger, self.sync, self._Callback)
-        self.syncThread.start()
+        self.scheduler.submit(self)
+
+    def _getChanges(self):
+        # Events arriving after this point are kept in list1 for the next run,
+        # a reversesync marked its changes when it claimed them
+        if not Common.checkkey(self.sync,'pair'):
+            self.sync['listsent']=self.sync['list1'].mark()
+        if not Common.checkkey(self.sync,'incremental'):
+            return None
+        return self.sync['list1'].getPaths(self.sync['listsent'])
 
     def _Callback(self):
         self.logger.info("{}: Synchronization finished".format(self.sync['name']))
-        if self.waitsync.isSet():
-            self._startSync()
-            self.waitsync.clear()
-        # wait for synchronization with events in list
-        time.sleep(SYNC_WAIT)
+        self.retrydelay=0
+        self.scheduler.release(self)
+        self._updateMetrics()
+        self._syncFinished()
+
+    def _syncFinished(self):
+        # rsync retries a failed local copy
+        self.copyfailed = isinstance(self.syncThread, copyThread) and self.syncThread.returncode != 0
+        if self.syncThread.returncode == 0:
+            self.sync['list1'].discard(self.sync['listsent'])
+            if self.eventtime:
+                self.metrics.observe("latency_seconds", self.sync['name'], time.time() - self.eventtime)
+        else:
+            if self.eventtime and (not self.sync['eventtime'] or self.eventtime < self.sync['eventtime']):
+                self.sync['eventtime']=self.eventtime
+            if isinstance(self.syncThread, shardThread) and Common.checkkey(self.sync,'incremental') and not os.curdir in self.syncThread.failed:
+                # only the failed shards are synced again
+                self.sync['list1'].discard(self.sync['listsent'])
+                for shard in self.syncThread.failed:
+                    self.sync['list1'].add(shard, True, "created")
+                self.logger.info("{}: {} failed shards kept for next synchronization".format(self.sync['name'], len(self.syncThread.failed)))
+            else:
+                # Keep the changes of a failed transfer for the next run
+                self.logger.info("{}: Changes kept for next synchronization".format(self.sync['name']))
+        self.busy=False
+        self._releasePair(True)
         self.sync['1'].set()
-        self.sync['list1'].clear()
+        self.idle.set()
         if self.callback:
             self.callback()
+        if self.waitsync.isSet():
+            self.waitsync.clear()
+            self._startSync()
+        self.metrics.write()
+
+    def _releasePair(self, settle):
+        # events held for this run are queued for the other direction
+        if Common.checkkey(self.sync,'pair'):
+            other, held = self.sync['pair'].release(self.sync, settle)
+            if held and other['handler']:
+                other['handler'].addHeld(held)
+            else:
+                for relpath, isdir, evtype in held:
+                    other['list1'].add(relpath, isdir, evtype)
+
+    def _updateMetrics(self):
+        name=self.sync['name']
+        self.metrics.observe("sync_duration_seconds", name, time.time() - self.starttime)
+        if self.syncThread.returncode != 0:
+            self.metrics.inc("sync_errors_total", name)
+        self.metrics.inc("sync_files_total", name, self.syncThread.stats.get("transferred", 0))
+        self.metrics.inc("sync_bytes_total", name, self.syncThread.stats.get("transferredsize", 0))
+
+#########################################################
+# Class : TimestampStore                                #
+#########################################################
+class TimestampStore(object):
+    # The timestamps in TS_FILENAME on both sides of a sync. The values are
+    # cached with the inode, mtime and size of the file, so they are only
+    # read again when a stat shows the file changed. Files are replaced
+    # atomically. Every destination of a job after the first has its own
+    # files, named after its number.
+    def __init__(self, source, destination, target = None):
+        filename = TS_FILENAME
+        if target and target > 1:
+            filename = "{}.{}".format(TS_FILENAME, target)
+        self.paths=[os.path.join(source, filename), os.path.join(destination, filename)]
+        self.cache={}
+
+    def isValid(self):
+        srcTs, dstTs = [self._read(path) for path in self.paths]
+        return ((srcTs>0) and (dstTs>0) and (srcTs == dstTs)) or ((srcTs == -1) and (dstTs == -1))
+
+    def update(self):
+        ts = str(time.time())
+        for path in self.paths:
+            tmppath = path + ".tmp"
+            try:
+                with open(tmppath, "w") as ts_file:
+                    ts_file.write(ts)
+                os.replace(tmppath, path)
+                self.cache[path] = (self._getKey(os.stat(path)), float(ts))
+            except Exception:
+                self.cache.pop(path, None)
+                return False
+        return True
+
+    def _read(self, path):
+        try:
+            key = self._getKey(os.stat(path))
+        except FileNotFoundError:
+            return -1
+        except OSError:
+            return 0
+        if path in self.cache and self.cache[path][0] == key:
+            return self.cache[path][1]
+        try:
+            with open(path, "r") as ts_file:
+                ts = float(ts_file.read())
+        except Exception:
+            ts = 0
+        self.cache[path] = (key, ts)
+        return ts
+
+    def _getKey(self, st):
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+#########################################################
+# Class : SyncPair                                      #
+#########################################################
+class SyncPair(object):
+    # Both directions of a reversesync. A direction claims the paths of a run
+    # before it starts, a run waits only while the other direction claimed
+    # overlapping paths. Events on the paths claimed by the other direction
+    # are held until its run finished, then they are dropped when source and
+    # destination are equal (written by the run) and queued otherwise. Later
+    # events on the paths of the last run of the other direction are checked
+    # the same way, so no time window is needed.
+    def __init__(self):
+        self.syncs=[]
+        self.claims={}
+        self.settled={}
+        self.held={}
+        self.mutex=Lock()
+        self.tsLock=Lock()
+
+    def add(self, sync):
+        self.syncs.append(sync)
+
+    def claim(self, sync):
+        # marks the changes of the next run, False while they overlap the other direction
+        other = self._getOther(sync)
+        self.mutex.acquire()
+        mark = sync['list1'].mark()
+        paths = None
+        if Common.checkkey(sync,'incremental'):
+            paths = sync['list1'].getPaths(mark)
+        claimed = self.claims.get(other['name'], False)
+        if claimed != False and (claimed == None or paths == None or any(self._overlaps(claimed, path) for path in paths)):
+            self.mutex.release()
+            return False
+        sync['listsent'] = mark
+        self.claims[sync['name']] = self._getClaim(paths)
+        sync['1'].clear()
+        self.mutex.release()
+        return True
+
+    def release(self, sync, settle = True):
+        # returns the other sync and its events held for this run
+        other = self._getOther(sync)
+        self.mutex.acquire()
+        claimed = self.claims.pop(sync['name'], False)
+        if settle and claimed != False:
+            self.settled[sync['name']] = claimed
+        held = self.held.pop(sync['name'], [])
+        self.mutex.release()
+        return other, held
+
+    def check(self, sync, changes, isdir):
+        # returns the changes of an event that are not (yet) known as written by
+        # the other direction, and the number of changes ignored as such
+        other = self._getOther(sync)
+        kept = []
+        settled = []
+        held = 0
+        self.mutex.acquire()
+        claimed = self.claims.get(other['name'], False)
+        last = self.settled.get(other['name'], False)
+        for relpath, evtype in changes:
+            if not relpath:
+                kept.append((relpath, evtype))
+            elif claimed != False and self._overlaps(claimed, relpath):
+                self.held.setdefault(other['name'], []).append((relpath, isdir, evtype))
+                held += 1
+            elif last != False and self._overlaps(last, relpath):
+                settled.append((relpath, evtype))
+            else:
+                kept.append((relpath, evtype))
+        self.mutex.release()
+        ignored = len(changes) - len(kept) - len(settled) - held
+        for relpath, evtype in settled:
+            if self.isEqual(sync, relpath):
+                ignored += 1
+            else:
+                kept.append((relpath, evtype))
+        return kept, ignored
+
+    def isEqual(self, sync, relpath):
+        # rsync keeps size and mtime
+        try:
+            source = self._getStat(os.path.join(sync['source'], relpath))
+            destination = self._getStat(os.path.join(sync['destination'], relpath))
+        except OSError:
+            return False
+        if source == None or destination == None:
+            return source == destination
+        if stat.S_IFMT(source.st_mode) != stat.S_IFMT(destination.st_mode):
+            return False
+        if stat.S_ISDIR(source.st_mode):
+            return True
+        if stat.S_ISLNK(source.st_mode):
+            return os.readlink(os.path.join(sync['source'], relpath)) == os.readlink(os.path.join(sync['destination'], relpath))
+        return source.st_size == destination.st_size and int(source.st_mtime) == int(destination.st_mtime)
+
+    def _getStat(self, path):
+        try:
+            return os.lstat(path)
+        except FileNotFoundError:
+            return None
+
+    def _getOther(self, sync):
+        return [other for other in self.syncs if other is not sync][0]
+
+    def _getClaim(self, paths):
+        # None claims everything, otherwise the paths and their parent folders
+        if paths == None:
+            return None
+        parents = set()
+        for relpath in paths:
+            parent = os.path.dirname(relpath)
+            while parent and not parent in parents:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        return (set(paths), parents)
+
+    def _overlaps(self, claimed, relpath):
+        if claimed == None:
+            return True
+        paths, parents = claimed
+        # rsync writes to a temporary file .name.xxxxxx first
+        head, tail = os.path.split(relpath)
+        if tail.startswith('.') and tail.count('.') > 1:
+            relpath = os.path.join(head, tail[1:tail.rfind('.')])
+        if relpath in paths or relpath in parents:
+            return True
+        parent = os.path.dirname(relpath)
+        while parent:
+            if parent in paths:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+#########################################################
+# Class : EventSummary                                  #
+#########################################################
+class EventSummary(object):
+    # Counts the events of a sync by type. The counts are logged as one line
+    # when the sync starts or every LOG_SUMMARY seconds, the events
+    # themselves are only logged at debug level.
+    def __init__(self, logger, name):
+        self.logger=logger
+        self.name=name
+        self.counts={}
+        self.started=0
+        self.mutex=Lock()
+
+    def add(self, evtype):
+        self.mutex.acquire()
+        now=time.time()
+        if not self.counts:
+            self.started=now
+        self.counts[evtype]=self.counts.get(evtype, 0) + 1
+        due = now - self.started >= LOG_SUMMARY
+        self.mutex.release()
+        if due:
+            self.flush()
+
+    def flush(self):
+        self.mutex.acquire()
+        counts=self.counts
+        started=self.started
+        self.counts={}
+        self.mutex.release()
+        if counts:
+            summary=", ".join(["{} {}".format(count, evtype) for evtype, count in sorted(counts.items(), key=lambda item: -item[1])])
+            self.logger.info("{}: {} in {:.0f}s".format(self.name, summary, time.time() - started))
 
 #########################################################
 # Class : SyncHandler                                   #
 #########################################################
 class SyncHandler(FileSystemEventHandler):
-    def __init__(self, logger, sync):
+    def __init__(self, logger, sync, scheduler, metrics, engine):
         self.sync = sync
         self.logger = logger
-        self.tsFail = False
+        self.metrics = metrics
+        self.engine = engine
+        self.timestamps = TimestampStore(sync['source'], sync['destination'], Common.checkkey(sync,'target'))
+        self.filter = PathFilter(sync)
+        self.tsBackoff = 0
+        self.summary = EventSummary(logger, sync['name'])
         self.logger.info("{}: Starting watch".format(self.sync['name']))
         if not Common.checkkey(sync,'delay'):
             self.logger.info("{}: No sync delay set with <delay>, default to {} seconds".format(self.sync['name'],DEF_DELAY))
             sync['delay']=DEF_DELAY
-        self.rsync=rsync(logger, sync, self._Callback)
-        self.timer=SyncTimer(sync['delay'], sync['resettimer'], self.onTimer)
+        self.rsync=rsync(logger, sync, scheduler, metrics, engine, self._Callback)
+        self.quiescence=Common.checkkey(sync,'quiescence')
+        self.sizes={}
+        self.timer=SyncTimer(engine, sync['delay'], sync['resettimer'], self.onTimer, Common.checkkey(sync,'maxdelay'), Common.checkkey(sync,'adaptivedelay'))
         if Common.checkkey(sync,'initsync'):
             self.on_any_event(None)
+        elif len(sync['list1']):
+            self.logger.info("{}: Resuming {} pending changes".format(self.sync['name'], len(sync['list1'])))
+            self.sync['eventtime']=time.time()
+            self.timer.start()
 
     def __del__(self):
+        self.summary.flush()
         self.logger.info("{}: Stopping watch".format(self.sync['name']))
         del self.timer
         del self.rsync
@@ -252,128 +2375,597 @@ class SyncHandler(FileSystemEventHandler):
     def on_any_event(self, event):
         if not event:
             self.logger.info("{}: Execute initial sync".format(self.sync['name']))
+            self.sync['eventtime']=time.time()
+            self.sync['list1'].setFull()
             self.timer.start()
+        elif not self._isLeader():
+            return
         else:
-            exec = True
-            if self.sync['2']:
-                if not self.sync['2'].isSet():
-                    exec = self.doIgnoreFromList(event)
-            if os.path.split(event.src_path)[1] == TS_FILENAME:
-                exec = False
-            if exec:
-                self.addToList(event)
-                self.logger.info("{}: {} event detected on {}".format(self.sync['name'], event.event_type, event.src_path))
-                self.timer.start()
-
-    def addToList(self, event):
-        li = {"type":event.event_type, "dir":event.is_directory, "path":event.src_path}
-        if li not in self.sync['list1']:
-            self.sync['list1'].append(li)
-
-    def doIgnoreFromList(self, event):
-        exec = True
-
-        if event.is_directory:
-            if os.path.normpath(event.src_path) == os.path.normpath(self.sync["source"]):
-                exec = False
+            if os.path.split(event.src_path)[1].startswith(TS_FILENAME):
+                return
+            elif event.is_directory and event.event_type == "modified" and self.sync['list1'].relpath(event.src_path) == os.curdir:
+                # watchdog reports the folder of a written file as modified, so every
+                # TS_FILENAME update would start the next sync. Created, deleted
+                # and moved entries of the root have their own events.
+                return
+            changes = self._getChanges(event)
+            if self.filter and not changes:
+                self.metrics.inc("events_excluded_total", self.sync['name'])
+                return
+            if Common.checkkey(self.sync,'pair'):
+                changes, ignored = self.sync['pair'].check(self.sync, changes, event.is_directory)
+                if ignored:
+                    self.metrics.inc("events_ignored_total", self.sync['name'], ignored)
+                if not changes:
+                    return
+            self.metrics.inc("events_total", self.sync['name'], type=event.event_type)
+            self.addToList(changes, event.is_directory)
+            self.summary.add(event.event_type)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("{}: {} event detected on {}".format(self.sync['name'], event.event_type, event.src_path))
+            self.triggerGroup()
+
+    def trigger(self):
+        if not self.sync['eventtime']:
+            self.sync['eventtime']=time.time()
+        self.timer.start()
+
+    def triggerGroup(self):
+        for sync in self._getGroup():
+            if sync['handler']:
+                sync['handler'].trigger()
+
+    def addChanges(self, changes):
+        # changes made while not watched, as (relpath, isdir, evtype)
+        for relpath, isdir, evtype in changes:
+            self.addToList([(relpath, evtype)], isdir)
+        if changes:
+            self.triggerGroup()
+
+    def addHeld(self, held):
+        # events held while the other direction synced the same paths
+        kept = []
+        for relpath, isdir, evtype in held:
+            if self.sync['pair'].isEqual(self.sync, relpath):
+                self.metrics.inc("events_ignored_total", self.sync['name'])
             else:
-                for li in self.sync['list2']:
-                    if li["dir"]:
-                        if self._checkPath(event.src_path, li["path"], False):
-                            exec=False
-        else:
-            for li in self.sync['list2']:
-                if not li["dir"]:
-                    if self._checkPath(event.src_path, li["path"]):
-                        #if path if true then check file or temp based file
-                        if self._checkFile(event.src_path, li["path"]):
-                            exec=False
-        return exec
-
-    def _checkPath(self, src_path, dest_path, psplit = True):
-        if psplit:
-            p1 = os.path.split(src_path)
-            p2 = os.path.split(dest_path)
-        else:
-            p1 = (os.path.normpath(src_path),"")
-            p2 = (os.path.normpath(dest_path),"")
-        p1=p1 + (self._getPathPart(p1[0],self.sync["source"]),)
-        p2=p2 + (self._getPathPart(p2[0],self.sync["destination"]),)
-        return p1[2] == p2[2]
-
-    def _getPathPart(self, src_path, cmp_path):
-        new_path = ""
-        if src_path.startswith(os.path.normpath(cmp_path)):
-            new_path=src_path.replace(os.path.normpath(cmp_path),"")
-        return new_path
-
-    def _checkFile(self, src_path, dest_path):
-        same = False
-        p1 = os.path.split(src_path)
-        p2 = os.path.split(dest_path)
-
-        if p1[1] == p2[1]:
-            same = True
-        elif p1[1].find('.'+p2[1]+'.') == 0:
-            same = True
-        return same
-
-    def _checkTsValid(self):
-        srcTs = -1
-        dstTs = -1
-        srcTsPath = os.path.join(self.sync["source"], TS_FILENAME)
-        dstTsPath = os.path.join(self.sync["destination"], TS_FILENAME)
-        if os.path.isfile(srcTsPath):
-            try:
-                with open(srcTsPath, "r") as srcTs_file:
-                    srcTs = float(srcTs_file.read())
-            except:
-                srcTs = 0
-        if os.path.isfile(dstTsPath):
-            try:
-                with open(dstTsPath, "r") as dstTs_file:
-                    dstTs = float(dstTs_file.read())
-            except:
-                dstTs = 0
-        return ((srcTs>0) and (dstTs>0) and (srcTs == dstTs)) or ((srcTs == -1) and (dstTs == -1))
+                self.addToList([(relpath, evtype)], isdir)
+                kept.append(relpath)
+        if kept:
+            self.logger.info("{}: {} changes made during the reverse action".format(self.sync['name'], len(kept)))
+            self.trigger()
 
-    def _updateTs(self):
-        retval = True
-        srcTsPath = os.path.join(self.sync["source"], TS_FILENAME)
-        dstTsPath = os.path.join(self.sync["destination"], TS_FILENAME)
-        ts = time.time()
-        try:
-            with open(srcTsPath, "w") as srcTs_file:
-                srcTs_file.write(str(ts))
-        except:
-            retval = False
-        if retval:
-            try:
-                with open(dstTsPath, "w") as dstTs_file:
-                    dstTs_file.write(str(ts))
-            except:
-                retval = False
-        return retval
+    def addToList(self, changes, isdir):
+        # the changes of a fan-out are added for every destination, also when offline
+        lists = [sync['list1'] for sync in self._getGroup()]
+        for relpath, evtype in changes:
+            for changeset in lists:
+                if not relpath:
+                    # moved in or out of the source folder
+                    pass
+                elif relpath == os.curdir:
+                    if evtype != "modified":
+                        changeset.setFull()
+                else:
+                    changeset.add(relpath, isdir, evtype)
+
+    def _getGroup(self):
+        # the syncs sharing the watch of the source, with a single destination only this one
+        return Common.checkkey(self.sync,'group') or [self.sync]
+
+    def _isLeader(self):
+        # the events of a fan-out are handled by its first online sync
+        for sync in self._getGroup():
+            if sync['handler']:
+                return sync['handler'] is self
+        return True
+
+    def _getChanges(self, event):
+        # relative paths and event types for the list, without excluded paths
+        if event.event_type == "moved":
+            changes = [(event.src_path, "deleted"), (event.dest_path, "created")]
+        else:
+            changes = [(event.src_path, event.event_type)]
+        changes = [(self.sync['list1'].relpath(path), evtype) for path, evtype in changes]
+        return [(relpath, evtype) for relpath, evtype in changes if not relpath or self.filter.isIncluded(relpath, event.is_directory)]
 
     def _Callback(self):
-        self._updateTs()
+        if not self._lockTimestamps(self.timestamps.update):
+            self.logger.error("{}: Error writing timestamp".format(self.sync['name']))
+        if Common.checkkey(self.sync,'downstream'):
+            self._forward()
+
+    def _forward(self):
+        # pipeline: the destinations after the first are synced from its copy.
+        # After a full sync they are synced in full, also when parts failed.
+        # Folders are only listed when they need a transfer, so they are
+        # forwarded as created to sync their contents as well.
+        changes = self.rsync.changes
+        if self.rsync.syncThread.returncode != 0 and changes != None:
+            return
+        for sync in self.sync['downstream']:
+            if changes == None:
+                sync['list1'].setFull()
+            for relpath in changes or []:
+                path = os.path.join(self.sync['destination'], relpath)
+                if not os.path.lexists(path):
+                    sync['list1'].add(relpath, False, "deleted")
+                elif os.path.isdir(path) and not os.path.islink(path):
+                    sync['list1'].add(relpath, True, "created")
+                else:
+                    sync['list1'].add(relpath, False, "modified")
+            if sync['handler']:
+                sync['handler'].trigger()
+
+    def _getUnsettled(self):
+        # returns the time to wait until all changed files are unchanged for quiescence seconds
+        wait = 0
+        sizes = {}
+        now = time.time()
+        for relpath in self.sync['list1'].getFiles(QUIET_FILES):
+            try:
+                st = os.stat(os.path.join(self.sync['source'], relpath))
+            except OSError:
+                continue
+            sizes[relpath] = st.st_size
+            if st.st_size != self.sizes.get(relpath, st.st_size):
+                wait = self.quiescence
+            else:
+                wait = max(wait, self.quiescence - (now - st.st_mtime))
+        self.sizes = sizes
+        return min(wait, self.quiescence)
 
     def onTimer(self):
-        self.timer.clear()
-        if self.sync['2']:
-            if not self.sync['2'].isSet():
-                self.logger.info("{}: Waiting on reverse action to finish".format(self.sync['name']))
-                self.sync['2'].wait()
-        if self._checkTsValid():
-            if self.tsFail:
-                self.tsFail = False
+        if self.quiescence:
+            wait = self._getUnsettled()
+            if wait > 0 and self.timer.postpone(wait):
+                self.logger.info("{}: Files still changing, waiting {:.1f} seconds".format(self.sync['name'], wait))
+                return
+            self.sizes = {}
+        self.summary.flush()
+        self.metrics.observe("debounce_seconds", self.sync['name'], self.timer.clear())
+        self._startSync()
+
+    def _lockTimestamps(self, method):
+        # both directions of a reversesync share the timestamp files
+        if not Common.checkkey(self.sync,'pair'):
+            return method()
+        self.sync['pair'].tsLock.acquire()
+        result = method()
+        self.sync['pair'].tsLock.release()
+        return result
+
+    def _startSync(self):
+        if self._lockTimestamps(self.timestamps.isValid):
+            if self.tsBackoff:
+                self.tsBackoff = 0
                 self.logger.info("{}: Timestamp mismatch fixed".format(self.sync['name']))
+                self.metrics.set("timestamp_mismatch", self.sync['name'], 0)
             self.rsync()
         else:
-            if not self.tsFail:
-                self.tsFail = True
+            if not self.tsBackoff:
+                self.tsBackoff = self.sync['delay']
                 self.logger.error("{}: Timestamp mismatch, keep retrying ...".format(self.sync['name']))
-            self.timer.start() # try again at timeout
+                self.metrics.set("timestamp_mismatch", self.sync['name'], 1)
+                self.metrics.write()
+            else:
+                self.tsBackoff = min(self.tsBackoff * 2, RETRY_MAX)
+            self.timer.retry(self.tsBackoff)
+
+#########################################################
+# Class : WatchEngine                                   #
+#########################################################
+class WatchEngine(FileSystemEventHandler):
+    # One observer for all syncs. Every folder is watched once, by the
+    # topmost sync root containing it, and events are passed on to every
+    # handler whose root contains the event path.
+    def __init__(self, logger):
+        self.logger=logger
+        self.observer=Observer()
+        self.handlers={}
+        self.watches={}
+        self.mutex=Lock()
+
+    def __del__(self):
+        del self.observer
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+    def schedule(self, handler, path):
+        root = os.path.normpath(path)
+        self.mutex.acquire()
+        if not root in self.handlers:
+            self.handlers[root]=[]
+        self.handlers[root].append(handler)
+        if not self._getWatchRoot(root):
+            self.watches[root]=self.observer.schedule(self, path=root, recursive=True)
+            for nested in [nested for nested in self.watches if nested.startswith(os.path.join(root,''))]:
+                self.observer.unschedule(self.watches[nested])
+                del self.watches[nested]
+        self.mutex.release()
+
+    def unschedule(self, handler, path):
+        root = os.path.normpath(path)
+        self.mutex.acquire()
+        if root in self.handlers and handler in self.handlers[root]:
+            self.handlers[root].remove(handler)
+            if not self.handlers[root]:
+                del self.handlers[root]
+                if root in self.watches:
+                    try:
+                        self.observer.unschedule(self.watches[root])
+                    except Exception:
+                        # the emitter already stopped, e.g. when unmounted
+                        pass
+                    del self.watches[root]
+                    # watch the roots that were nested in this one again
+                    for nested in sorted(self.handlers):
+                        if nested.startswith(os.path.join(root,'')) and not self._getWatchRoot(nested):
+                            self.watches[nested]=self.observer.schedule(self, path=nested, recursive=True)
+        self.mutex.release()
+
+    def dispatch(self, event):
+        # opened and closed events are also sent for reading, e.g. by rsync or the scrub
+        if not event.event_type in CHG_EVENTS:
+            return
+        paths = [event.src_path]
+        if hasattr(event, "dest_path") and event.dest_path:
+            paths.append(event.dest_path)
+        handlers = []
+        self.mutex.acquire()
+        for path in paths:
+            parent = os.path.normpath(os.fsdecode(path))
+            while True:
+                for handler in self.handlers.get(parent, []):
+                    if not handler in handlers:
+                        handlers.append(handler)
+                if os.path.dirname(parent) == parent:
+                    break
+                parent = os.path.dirname(parent)
+        self.mutex.release()
+        for handler in handlers:
+            handler.dispatch(event)
+
+    def getWatches(self, path):
+        # Number of folders watched for path, inotify watches every folder of a recursive watch
+        watches = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.normpath(path)):
+            watches += 1
+        return watches
+
+    def getTotalWatches(self):
+        self.mutex.acquire()
+        roots = list(self.watches)
+        self.mutex.release()
+        return sum([self.getWatches(root) for root in roots])
+
+    def _getWatchRoot(self, root):
+        watchroot = None
+        parent = root
+        while True:
+            if parent in self.watches:
+                watchroot = parent
+            if os.path.dirname(parent) == parent:
+                break
+            parent = os.path.dirname(parent)
+        return watchroot
+
+#########################################################
+# Class : MountMonitor                                  #
+#########################################################
+class MountMonitor(Thread):
+    # Checks whether the source and destination of the syncs are available.
+    # All syncs are checked when the mount table changes, offline syncs are
+    # also checked with exponential backoff and online syncs every RETRY_MAX
+    # seconds. online(sync) and offline(sync) are called on every change,
+    # holding lock. A sync removed meanwhile is not called anymore.
+    def __init__(self, logger, online, offline, lock):
+        Thread.__init__(self)
+        self.daemon=True
+        self.logger=logger
+        self.online=online
+        self.offline=offline
+        self.lock=lock
+        self.syncs={}
+        self.mutex=Lock()
+        self.wakeup=os.pipe()
+        self.stopped=False
+
+    def add(self, sync, online):
+        self.mutex.acquire()
+        self.syncs[sync['name']]={"sync":sync, "online":online, "backoff":RETRY_DELAY, "next":self._getNext(online, RETRY_DELAY)}
+        self.mutex.release()
+        os.write(self.wakeup[1], b"\0")
+
+    def remove(self, sync):
+        # waits for the callbacks of a check in progress
+        self.lock.acquire()
+        self.mutex.acquire()
+        if sync['name'] in self.syncs and self.syncs[sync['name']]["sync"] is sync:
+            del self.syncs[sync['name']]
+        self.mutex.release()
+        self.lock.release()
+
+    def stop(self):
+        self.stopped=True
+        os.write(self.wakeup[1], b"\0")
+        self.join()
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.wakeup[0], select.POLLIN)
+        mountinfo = None
+        try:
+            mountinfo = open(MOUNTINFO, "rb")
+            mountinfo.read()
+            # the mount table signals changes with POLLPRI and POLLERR
+            poller.register(mountinfo, select.POLLPRI | select.POLLERR)
+        except Exception as e:
+            self.logger.info("Mount changes not monitored ({}), checking with backoff only".format(e))
+        while not self.stopped:
+            timeout = max(self._getTimeout(), 0)
+            mounted = False
+            for fd, mask in poller.poll(timeout * 1000):
+                if fd == self.wakeup[0]:
+                    os.read(self.wakeup[0], 1024)
+                elif mountinfo:
+                    mountinfo.seek(0)
+                    mountinfo.read()
+                    mounted = True
+            if not self.stopped:
+                self._check(mounted)
+        if mountinfo:
+            mountinfo.close()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def _check(self, mounted):
+        now = time.time()
+        self.mutex.acquire()
+        changed = []
+        for state in self.syncs.values():
+            if mounted or state["next"] <= now:
+                online = self._isOnline(state["sync"])
+                if online != state["online"]:
+                    state["online"] = online
+                    state["backoff"] = RETRY_DELAY
+                    changed.append(state)
+                elif not online:
+                    state["backoff"] = min(state["backoff"] * 2, RETRY_MAX)
+                state["next"] = self._getNext(online, state["backoff"])
+        self.mutex.release()
+        for state in changed:
+            self.lock.acquire()
+            self.mutex.acquire()
+            current = self.syncs.get(state["sync"]['name']) is state
+            self.mutex.release()
+            if current and state["online"]:
+                self.online(state["sync"])
+            elif current:
+                self.offline(state["sync"])
+            self.lock.release()
+
+    def _getTimeout(self):
+        self.mutex.acquire()
+        timeout = RETRY_MAX
+        if self.syncs:
+            timeout = min(state["next"] for state in self.syncs.values()) - time.time()
+        self.mutex.release()
+        return timeout
+
+    def _getNext(self, online, backoff):
+        if online:
+            return time.time() + RETRY_MAX
+        return time.time() + backoff
+
+    def _isOnline(self, sync):
+        return os.path.isdir(sync['source']) and os.path.isdir(sync['destination'])
+
+#########################################################
+# Class : Scrubber                                      #
+#########################################################
+class Scrubber(Thread):
+    # Compares the contents of source and destination of the syncs with
+    # <scrub> every <scrub> hours. Both locations are summarized as a tree of
+    # content hashes per folder (Merkle tree), subtrees with equal hashes are
+    # skipped in the comparison. Only files changed since the last scrub are
+    # read, at most <scrubrate> MB/s. Drifted paths are queued for the sync.
+    def __init__(self, logger, metrics, journalpath, rate):
+        Thread.__init__(self)
+        self.daemon=True
+        self.logger=logger
+        self.metrics=metrics
+        self.journalpath=journalpath
+        self.syncs={}
+        self.mutex=Lock()
+        self.wakeup=Event()
+        self.stopevent=Event()
+        self.debt=0
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        if not rate:
+            rate = SCRUB_RATE
+        self.rate = rate * 1024 * 1024
+
+    def add(self, sync):
+        if Common.isremote(sync['source']) or Common.isremote(sync['destination']):
+            self.logger.info("{}: Remote location, not scrubbed".format(sync['name']))
+            return
+        interval = sync['scrub'] * 3600
+        self.mutex.acquire()
+        self.syncs[sync['name']]={"sync":sync, "interval":interval, "next":time.time() + interval, "caches":None}
+        self.mutex.release()
+        self.wakeup.set()
+
+    def remove(self, sync):
+        self.mutex.acquire()
+        if sync['name'] in self.syncs and self.syncs[sync['name']]["sync"] is sync:
+            del self.syncs[sync['name']]
+        self.mutex.release()
+
+    def stop(self):
+        self.stopevent.set()
+        self.wakeup.set()
+        self.join()
+
+    def run(self):
+        while not self.stopevent.isSet():
+            self.wakeup.wait(max(self._getTimeout(), 0))
+            self.wakeup.clear()
+            state = self._getDue()
+            if state and not self.stopevent.isSet():
+                self._scrub(state)
+
+    def _getTimeout(self):
+        self.mutex.acquire()
+        timeout = RETRY_MAX
+        if self.syncs:
+            timeout = min(state["next"] for state in self.syncs.values()) - time.time()
+        self.mutex.release()
+        return timeout
+
+    def _getDue(self):
+        now = time.time()
+        due = None
+        self.mutex.acquire()
+        for state in self.syncs.values():
+            if state["next"] <= now and (not due or state["next"] < due["next"]):
+                due = state
+        self.mutex.release()
+        return due
+
+    def _scrub(self, state):
+        sync = state["sync"]
+        handler = sync['handler']
+        syncs = sync['pair'].syncs if sync['pair'] else [sync]
+        if not handler or any(self._isBusy(other) for other in syncs):
+            # pending changes of both directions would be found as drift
+            state["next"] = time.time() + RETRY_DELAY
+            return
+        starttime = time.time()
+        self.logger.info("{}: Scrub started".format(sync['name']))
+        if not state["caches"]:
+            state["caches"] = [HashCache(self.logger, self._getCachePath(sync, key), sync[key]) for key in ('source', 'destination')]
+        trees = []
+        # the cache of the handler filter is not shared between threads
+        pathfilter = PathFilter(sync)
+        for key, cache in zip(('source', 'destination'), state["caches"]):
+            tree = self._summarize(sync[key], os.curdir, cache, pathfilter)
+            if tree == None:
+                return
+            trees.append(tree)
+        for cache in state["caches"]:
+            cache.save()
+        # with reversesync, files only on the destination may be new there
+        delete = Common.checkkey(sync,'delete') and not Common.checkkey(sync,'reversesync')
+        drift = []
+        self._compare(trees[0], trees[1], os.curdir, delete, drift)
+        for relpath, isdir, evtype in drift:
+            sync['list1'].add(relpath, isdir, evtype)
+        if drift and sync['handler']:
+            if not sync['eventtime']:
+                sync['eventtime'] = time.time()
+            sync['handler'].timer.start()
+        self.metrics.inc("scrub_drift_total", sync['name'], len(drift))
+        self.metrics.observe("scrub_duration_seconds", sync['name'], time.time() - starttime)
+        self.logger.info("{}: Scrub finished, {} drifted paths queued for synchronization".format(sync['name'], len(drift)))
+        state["next"] = time.time() + state["interval"]
+
+    def _isBusy(self, sync):
+        return len(sync['list1']) or (sync['handler'] and sync['handler'].rsync.busy)
+
+    def _summarize(self, root, relpath, cache, pathfilter):
+        # returns (hash, {name: node}) of a folder, files have no children.
+        # The hash is None for an unreadable folder, the tree is None when stopped.
+        children = {}
+        try:
+            entries = sorted(os.scandir(os.path.join(root, relpath)), key=lambda entry: entry.name)
+        except OSError as e:
+            self.logger.error("Error reading {} for scrub: {}".format(os.path.join(root, relpath), e))
+            return (None, children)
+        hasher = hashlib.blake2b(digest_size=16)
+        for entry in entries:
+            if entry.name.startswith(TS_FILENAME):
+                continue
+            childpath = entry.name if relpath == os.curdir else os.path.join(relpath, entry.name)
+            try:
+                isdir = entry.is_dir(follow_symlinks=False)
+                if not pathfilter.isIncluded(childpath, isdir):
+                    continue
+                if isdir:
+                    node = self._summarize(root, childpath, cache, pathfilter)
+                elif entry.is_symlink():
+                    node = (hashlib.blake2b(b"L" + os.fsencode(os.readlink(entry.path)), digest_size=16).digest(), None)
+                elif entry.is_file(follow_symlinks=False):
+                    node = (self._getHash(entry, childpath, cache), None)
+                    if node[0] == None:
+                        node = None
+                else:
+                    continue
+            except OSError:
+                # removed while scrubbing
+                continue
+            if node == None:
+                return None
+            children[entry.name] = node
+            hasher.update(os.fsencode(entry.name) + (b"\0D" if node[1] != None else b"\0F") + (node[0] or b"?"))
+        return (hasher.digest(), children)
+
+    def _getHash(self, entry, relpath, cache):
+        st = entry.stat(follow_symlinks=False)
+        digest = cache.get(relpath, st)
+        if digest == None:
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(entry.path, "rb") as hash_file:
+                while True:
+                    data = hash_file.read(READ_CHUNK)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    if self._throttle(len(data)):
+                        return None
+            digest = hasher.digest()
+            cache.put(relpath, st, digest)
+        return digest
+
+    def _throttle(self, size):
+        # returns True when stopped
+        self.debt += size
+        if self.debt * 10 < self.rate:
+            return False
+        wait = self.debt / self.rate
+        self.debt = 0
+        return self.stopevent.wait(wait)
+
+    def _compare(self, source, destination, relpath, delete, drift):
+        if source[0] == None or destination[0] == None or source[0] == destination[0]:
+            return
+        for name, node in source[1].items():
+            childpath = name if relpath == os.curdir else os.path.join(relpath, name)
+            other = destination[1].get(name)
+            if other == None or (node[1] == None) != (other[1] == None):
+                drift.append((childpath, node[1] != None, "created"))
+            elif node[1] != None:
+                self._compare(node, other, childpath, delete, drift)
+            elif node[0] != other[0]:
+                drift.append((childpath, False, "drift"))
+        if delete:
+            for name, node in destination[1].items():
+                if not name in source[1]:
+                    childpath = name if relpath == os.curdir else os.path.join(relpath, name)
+                    drift.append((childpath, node[1] != None, "deleted"))
+
+    def _getCachePath(self, sync, key):
+        if not self.journalpath:
+            return None
+        name = sync['name'].replace("-->","-forward").replace("<--","-reverse")
+        return os.path.join(self.journalpath, "{}.{}.hashes".format(name, key))
 
 #########################################################
 # Class : SyncWatch                                     #
@@ -381,27 +2973,51 @@ class SyncHandler(FileSystemEventHandler):
 class SyncWatch(object):
     def __init__(self):
         self.syncs = []
+        self.settings = {}
+        self.metrics = None
+        self.scheduler = None
+        self.journalpath = None
+        self.monitor = None
+        self.scrubber = None
+        self.engine = None
+        self.xmlpath = ""
+        # reloads and the mount monitor start and stop watches
+        self.mutex = RLock()
+        self.stopped = {}
         signal.signal(signal.SIGINT, self.exit_app)
         signal.signal(signal.SIGTERM, self.exit_app)
+        signal.signal(signal.SIGUSR1, self.log_status)
+        signal.signal(signal.SIGHUP, self.reload_app)
         self.exitevent = Event()
         self.exitevent.clear()
+        self.reloadevent = Event()
+        self.reloadevent.clear()
+        self.statusevent = Event()
+        self.statusevent.clear()
         self.logger = logging.getLogger('syncwatch')
         self.logger.setLevel(logging.INFO)
         # create file handler which logs even debug messages
         fh = logging.handlers.RotatingFileHandler(self.GetLogger(), maxBytes=LOG_MAXSIZE, backupCount=5)
         # create console handler with a higher log level
         ch = logging.StreamHandler(sys.stdout)
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
+        # file and console are written by a listener thread, not by the thread logging
+        logqueue = queue.SimpleQueue()
+        self.loghandler = logging.handlers.QueueHandler(logqueue)
+        self.logger.addHandler(self.loghandler)
+        self.loglistener = logging.handlers.QueueListener(logqueue, fh, ch)
+        self.loglistener.start()
+        atexit.register(self.StopLogging)
         logging.captureWarnings(True)
         tmformat=("{} {}".format(locale.nl_langinfo(locale.D_FMT),locale.nl_langinfo(locale.T_FMT)))
         tmformat=tmformat.replace("%y", "%Y")
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s', tmformat)
         fh.setFormatter(formatter)
         ch.setFormatter(formatter)
+        self.watcher = WatchEngine(self.logger)
 
     def __del__(self):
         del self.syncs
+        del self.watcher
         logging.shutdown()
 
     def run(self, argv):
@@ -412,52 +3028,235 @@ class SyncWatch(object):
             self.logger.error("{} not found, please install {} before running this program".format(SYNC_TOOL, SYNC_TOOL))
             exit(1)
 
+        self.SetLogLevel(self.settings)
         self.logger.info("Starting SyncWatch")
-        retries = []
+        self.metrics = SyncMetrics(self.logger, Common.checkkey(self.settings,'metricsfile'), Common.checkkey(self.settings,'metricsport'))
+        self.scheduler = SyncScheduler(self.logger, self.metrics, *self.GetLimits(self.settings))
+        self.journalpath = self.GetJournalPath()
+        self.monitor = MountMonitor(self.logger, self.SourceOnline, self.SourceOffline, self.mutex)
+        self.scrubber = Scrubber(self.logger, self.metrics, self.journalpath, Common.checkkey(self.settings,'scrubrate'))
+        if Common.checkkey(self.settings,'engine') == "asyncio":
+            self.logger.info("Using asyncio engine")
+            self.engine = AsyncEngine(self.logger)
+        else:
+            self.engine = ThreadEngine()
+        self.engine.start()
 
+        starttime = time.time()
+        self.watcher.start()
         for sync in self.syncs:
-            if Common.checkkey(sync,'source') and Common.checkkey(sync,'destination'):
-                if os.path.isdir(sync['source']) and os.path.isdir(sync['destination']):
-                    event_handler = SyncHandler(self.logger, sync)
-                    sync['observer'] = Observer()
-                    sync['observer'].schedule(event_handler, path=sync['source'], recursive=True)
-                    sync['observer'].start()
-                else:
-                    if Common.checkkey(sync,'retry'):
-                        self.logger.info("Source or destination path doesn't exist for {}, keep on retrying".format(sync['name']))
-                        retries.append(sync)
-                    else:
-                        self.logger.error("Source or destination path doesn't exist for {}, watch not created".format(sync['name']))
+            self.AddSync(sync)
+
+        self.logger.info("Watching {} folders for {} syncs, started in {:.1f}s".format(self.watcher.getTotalWatches(), len(self.syncs), time.time() - starttime))
+        self.monitor.start()
+        self.scrubber.start()
 
+        while not self.exitevent.isSet():
+            # signals may be delivered to another thread and not wake up the main thread
+            self.exitevent.wait(SYNC_WAIT)
+            if self.reloadevent.isSet() and not self.exitevent.isSet():
+                self.reloadevent.clear()
+                self.Reload()
+            if self.statusevent.isSet():
+                self.statusevent.clear()
+                self.LogStatus()
+            self.scheduler.poll()
+
+        self.monitor.stop()
+        self.scrubber.stop()
+        # still watched, changes made while saving are kept in the journal
+        for sync in self.syncs:
+            self.SaveSnapshot(sync)
+        self.watcher.stop()
+        self.engine.stop()
+        self.metrics.stop()
+        for sync in self.syncs:
+            sync['list1'].closeJournal()
+
+        self.logger.info("SyncWatch Ready")
+
+    def Reload(self):
+        # Only jobs that were added, removed or changed are restarted
+        self.logger.info("Reloading configuration")
+        try:
+            settings, syncs = self.ParseXML(self.xmlpath, self.logger)
+        except Exception as e:
+            self.logger.error("Error parsing xml file, configuration not reloaded")
+            self.logger.exception(e)
+            return
+        self.mutex.acquire()
+        oldjobs = self.GetJobs(self.syncs)
+        newjobs = self.GetJobs(syncs)
+        unchanged = [job for job in newjobs if job in oldjobs and newjobs[job][0]['config'] == oldjobs[job][0]['config']]
+        for job, jobsyncs in oldjobs.items():
+            if not job in unchanged:
+                self.logger.info("{}: Job {}, stopping".format(job, "changed" if job in newjobs else "removed"))
+                for sync in jobsyncs:
+                    self.RemoveSync(sync)
+        self.syncs = []
+        for job, jobsyncs in newjobs.items():
+            if job in unchanged:
+                self.syncs.extend(oldjobs[job])
             else:
-                self.logger.error("Source or destination path error for {}, watch not created".format(sync['name']))
+                self.logger.info("{}: Job {}, starting".format(job, "changed" if job in oldjobs else "added"))
+                for sync in jobsyncs:
+                    self.AddSync(sync)
+                self.syncs.extend(jobsyncs)
+
+        self.scheduler.setLimits(*self.GetLimits(settings))
+        self.SetLogLevel(settings)
+        self.scrubber.setRate(Common.checkkey(settings,'scrubrate'))
+        for key in ('metricsfile', 'metricsport', 'journaldir', 'engine'):
+            if Common.checkkey(settings, key) != Common.checkkey(self.settings, key):
+                self.logger.info("Setting {} changed, restart SyncWatch to apply".format(key))
+                settings[key] = Common.checkkey(self.settings, key)
+        self.settings = settings
+        self.mutex.release()
+        self.logger.info("Configuration reloaded, {} of {} jobs restarted".format(len(newjobs) - len(unchanged), len(newjobs)))
 
-        retrycnt = 0
-        while (len(retries)>0) and not self.exitevent.isSet():
-            time.sleep(SYNC_WAIT)
-            if retrycnt < RETRY_DELAY-1:
-                retrycnt += 1
+    def AddSync(self, sync):
+        if Common.checkkey(sync,'source') and Common.checkkey(sync,'destination'):
+            if os.path.isdir(sync['source']) and os.path.isdir(sync['destination']):
+                self.StartWatch(sync)
+                self.monitor.add(sync, True)
             else:
-                retrycnt = 0
+                if Common.checkkey(sync,'retry'):
+                    self.logger.info("Source or destination path doesn't exist for {}, keep on retrying".format(sync['name']))
+                    self.monitor.add(sync, False)
+                else:
+                    self.logger.error("Source or destination path doesn't exist for {}, watch not created".format(sync['name']))
 
-                for sync in retries:
-                    if os.path.isdir(sync['source']) and os.path.isdir(sync['destination']):
-                        event_handler = SyncHandler(self.logger, sync)
-                        sync['observer'] = Observer()
-                        sync['observer'].schedule(event_handler, path=sync['source'], recursive=True)
-                        sync['observer'].start()
-                        retries.remove(sync)
-                        self.logger.info("Source or destination path came online for {}".format(sync['name']))
+        else:
+            self.logger.error("Source or destination path error for {}, watch not created".format(sync['name']))
 
-        if not self.exitevent.isSet():
-            signal.pause()
+    def RemoveSync(self, sync):
+        self.monitor.remove(sync)
+        self.SaveSnapshot(sync)
+        self.StopWatch(sync)
+        sync['list1'].closeJournal()
 
-        for sync in self.syncs:
-            if Common.checkkey(sync,'observer'):
-                sync['observer'].stop()
-                sync['observer'].join()
+    def GetJobs(self, syncs):
+        jobs = {}
+        for sync in syncs:
+            jobs.setdefault(sync['job'], []).append(sync)
+        return jobs
 
-        self.logger.info("SyncWatch Ready")
+    def SetLogLevel(self, settings):
+        level = Common.checkkey(settings,'loglevel')
+        if not level:
+            level = "info"
+        if not str(level).upper() in ("DEBUG", "INFO", "WARNING", "ERROR"):
+            self.logger.error("Unknown log level {}, using info".format(level))
+            level = "info"
+        self.logger.setLevel(str(level).upper())
+
+    def StopLogging(self):
+        # writes the queued messages, later messages are written directly
+        if self.loglistener:
+            self.loglistener.stop()
+            self.logger.removeHandler(self.loghandler)
+            for handler in self.loglistener.handlers:
+                self.logger.addHandler(handler)
+            self.loglistener = None
+
+    def GetLimits(self, settings):
+        maxsyncs = Common.checkkey(settings,'maxsyncs')
+        if maxsyncs == None:
+            maxsyncs = DEF_MAXSYNCS
+        maxdevicesyncs = Common.checkkey(settings,'maxdevicesyncs')
+        if maxdevicesyncs == None:
+            maxdevicesyncs = DEF_DEVSYNCS
+        bandwidth = BandwidthSchedule(self.logger, "SyncWatch", Common.checkkey(settings,'bwlimit'))
+        return maxsyncs, maxdevicesyncs, bandwidth, settings
+
+    def SourceOnline(self, sync):
+        self.logger.info("Source or destination path came online for {}".format(sync['name']))
+        if not self.StartWatch(sync) and not Common.checkkey(sync,'initsync'):
+            # changes were missed while offline
+            sync['handler'].on_any_event(None)
+
+    def SourceOffline(self, sync):
+        self.logger.error("Source or destination path went offline for {}, keep on retrying".format(sync['name']))
+        self.StopWatch(sync)
+
+    def StartWatch(self, sync):
+        # returns whether the changes made while not watched are known from the snapshot
+        starttime = time.time()
+        if self.journalpath and not sync['list1'].journal:
+            journalname = sync['name'].replace("-->","-forward").replace("<--","-reverse") + ".journal"
+            sync['list1'].attachJournal(ChangeJournal(self.logger, os.path.join(self.journalpath, journalname), sync['source']))
+        sync['handler'] = SyncHandler(self.logger, sync, self.scheduler, self.metrics, self.engine)
+        sync['handler'].rsync.previous = self.stopped.pop(sync['name'], None)
+        if Common.checkkey(sync,'scrub') and not sync['name'].endswith("<--"):
+            self.scrubber.add(sync)
+        if Common.checkkey(sync,'upstream'):
+            self.logger.info("{}: Synchronizing after {}".format(sync['name'], sync['upstream']['name']))
+            return False
+        self.watcher.schedule(sync['handler'], sync['source'])
+        watches = self.watcher.getWatches(sync['source'])
+        self.metrics.set("watches", sync['name'], watches)
+        self.logger.info("{}: Watching {} folders in {:.1f}s".format(sync['name'], watches, time.time() - starttime))
+        known = self.CheckSnapshot(sync)
+        self.metrics.set("startup_seconds", sync['name'], time.time() - starttime)
+        return known
+
+    def CheckSnapshot(self, sync):
+        # queues the changes since the last snapshot and saves a new one
+        snapshot = self.GetSnapshot(sync)
+        if not snapshot:
+            return False
+        starttime = time.time()
+        old = None
+        if not Common.checkkey(sync,'initsync'):
+            old = snapshot.load()
+        new = snapshot.scan()
+        if old and not new:
+            # e.g. a mount point without its file system
+            self.logger.error("{}: Source is empty, snapshot not used".format(sync['name']))
+            return False
+        if not snapshot.complete:
+            if old == None:
+                return False
+            self.logger.error("{}: Snapshot incomplete, full synchronization needed".format(sync['name']))
+            sync['handler'].addChanges([(os.curdir, True, "created")])
+            return True
+        snapshot.save(new)
+        if old == None:
+            self.logger.info("{}: Snapshot of {} paths taken in {:.1f}s".format(sync['name'], len(new), time.time() - starttime))
+            return False
+        changes = snapshot.diff(old, new)
+        sync['handler'].addChanges(changes)
+        self.logger.info("{}: {} changes since the last snapshot, {} paths checked in {:.1f}s".format(sync['name'], len(changes), len(new), time.time() - starttime))
+        return True
+
+    def SaveSnapshot(self, sync):
+        # only while watched, an offline location may look empty
+        snapshot = self.GetSnapshot(sync)
+        if snapshot and sync['handler']:
+            entries = snapshot.scan()
+            if entries and snapshot.complete:
+                snapshot.save(entries)
+
+    def GetSnapshot(self, sync):
+        # one snapshot per watched source, the first destination of a job queues for all
+        if not self.journalpath or not Common.checkkey(sync,'snapshot') or Common.checkkey(sync,'upstream'):
+            return None
+        if Common.checkkey(sync,'target') and sync['target'] > 1:
+            return None
+        snapshotname = sync['name'].replace("-->","-forward").replace("<--","-reverse") + ".snapshot"
+        return DirSnapshot(self.logger, os.path.join(self.journalpath, snapshotname), sync)
+
+    def StopWatch(self, sync):
+        handler = sync['handler']
+        if handler:
+            sync['handler'] = None
+            self.scrubber.remove(sync)
+            self.watcher.unschedule(handler, sync['source'])
+            handler.timer.clear()
+            handler.rsync.cancel()
+            # the next watch of this sync waits for a running sync
+            self.stopped[sync['name']] = handler.rsync
+            self.metrics.set("watches", sync['name'], 0)
 
     def parseopts(self, argv):
         self.title()
@@ -487,15 +3286,12 @@ class SyncWatch(object):
                     if len(args) == 1:
                         found = False
                         for cursync in self.syncs:
-                            if cursync['name'].replace("-->","").replace("<--","") == args[0]:
+                            if cursync['job'] == args[0]:
                                 found = True
                                 print("Clearing errors for: " + cursync['name'])
-                                srcTsPath = os.path.join(cursync["source"], TS_FILENAME)
-                                dstTsPath = os.path.join(cursync["destination"], TS_FILENAME)
-                                if os.path.isfile(srcTsPath):
-                                    os.remove(srcTsPath)
-                                if os.path.isfile(dstTsPath):
-                                    os.remove(dstTsPath)
+                                for tsPath in TimestampStore(cursync["source"], cursync["destination"], Common.checkkey(cursync,'target')).paths:
+                                    if os.path.isfile(tsPath):
+                                        os.remove(tsPath)
                         if not found:
                             print("<sync> name doesn't exist")
                     else:
@@ -526,51 +3322,103 @@ class SyncWatch(object):
                     self.logger.error("No XML file found")
                     exit(1)
         try:
-            tree = ET.parse(XMLpath)
-            root = tree.getroot()
-
-            for child in root:
-                cursync={}
-                cursync['name']=child.tag
-                for toy in child:
-                    cursync[toy.tag]=Common.gettype(toy.text)
-                if Common.checkkey(cursync,'enabled') != None and not Common.checkkey(cursync,'enabled'):
-                    self.logger.info("{} is currently disabled and will not be synced".format(cursync['name']))
-                else:
-                    cursync['observer']=None
-                    origname=cursync['name']
-                    cursync['name']=origname+"-->"
-                    cursync['1']=Event()
-                    cursync['list1']=[]
-                    if Common.checkkey(cursync,'reversesync') == True:
-                        cursync['2']=Event()
-                        cursync['list2']=[]
-                    else:
-                        cursync['2']=None
-                        cursync['list2']=None
-                    self.syncs.append(cursync.copy())
-                    if Common.checkkey(cursync,'reversesync') == True:
-                        if Common.checkkey(cursync,'source') and Common.checkkey(cursync,'destination'):
-                            tempdest = cursync['destination']
-                            cursync['destination']=cursync['source']
-                            cursync['source']=tempdest
-                            cursync['name']=origname+"<--"
-                            temp2=cursync['2']
-                            cursync['2']=cursync['1']
-                            cursync['1']=temp2
-                            templist2=cursync['list2']
-                            cursync['list2']=cursync['list1']
-                            cursync['list1']=templist2
-                            self.syncs.append(cursync)
-                        else:
-                            print("Error adding job for reserve syncing")
-
+            self.settings, self.syncs = self.ParseXML(XMLpath, self.logger)
+            self.xmlpath = XMLpath
         except Exception as e:
             self.logger.error("Error parsing xml file")
             self.logger.error("Check XML file syntax for errors")
             self.logger.exception(e)
             exit(1)
 
+    @classmethod
+    def ParseXML(cls, XMLpath, logger):
+        settings = {}
+        syncs = []
+        tree = ET.parse(XMLpath)
+        root = tree.getroot()
+
+        for child in root:
+            if child.tag == SETTINGS_TAG:
+                for toy in child:
+                    settings[toy.tag]=Common.gettype(toy.text)
+                continue
+            cursync={}
+            cursync['name']=child.tag
+            for toy in child:
+                cursync[toy.tag]=Common.gettype(toy.text)
+            destinations=[Common.gettype(toy.text) for toy in child if toy.tag == 'destination']
+            # the job as configured, to find changed jobs on reload
+            cursync['config']=cursync.copy()
+            cursync['config']['destination']=destinations
+            cursync['job']=child.tag
+            if Common.checkkey(cursync,'enabled') != None and not Common.checkkey(cursync,'enabled'):
+                logger.info("{} is currently disabled and will not be synced".format(cursync['name']))
+            else:
+                cursync['handler']=None
+                origname=cursync['name']
+                if len(destinations) > 1 and Common.checkkey(cursync,'reversesync'):
+                    logger.error("{}: <reversesync> is not supported with multiple destinations, disabled".format(origname))
+                    cursync['reversesync']=False
+                cursync['name']=origname+"-->"
+                cursync['1']=Event()
+                if not Common.checkkey(cursync,'incrementalmax'):
+                    cursync['incrementalmax']=INC_MAXFILES
+                cursync['list1']=ChangeSet(Common.checkkey(cursync,'source'), cursync['incrementalmax'])
+                cursync['listsent']=0
+                cursync['eventtime']=None
+                if Common.checkkey(cursync,'reversesync') == True:
+                    cursync['2']=Event()
+                    cursync['pair']=SyncPair()
+                else:
+                    cursync['2']=None
+                    cursync['pair']=None
+                if len(destinations) > 1:
+                    syncs.extend(cls.GetTargets(cursync, destinations))
+                    continue
+                forward=cursync.copy()
+                syncs.append(forward)
+                if Common.checkkey(cursync,'reversesync') == True:
+                    if Common.checkkey(cursync,'source') and Common.checkkey(cursync,'destination'):
+                        tempdest = cursync['destination']
+                        cursync['destination']=cursync['source']
+                        cursync['source']=tempdest
+                        cursync['name']=origname+"<--"
+                        temp2=cursync['2']
+                        cursync['2']=cursync['1']
+                        cursync['1']=temp2
+                        cursync['list1']=ChangeSet(cursync['source'], cursync['incrementalmax'])
+                        cursync['pair'].add(forward)
+                        cursync['pair'].add(cursync)
+                        syncs.append(cursync)
+                    else:
+                        forward['pair']=None
+                        print("Error adding job for reserve syncing")
+
+        return settings, syncs
+
+    @classmethod
+    def GetTargets(cls, cursync, destinations):
+        # One sync per destination, with its own changes, timestamps and retries.
+        # The syncs in a group share the watch of the source, with <pipeline>
+        # the later destinations are synced from the first one when it finished.
+        targets = []
+        for index, destination in enumerate(destinations):
+            target = cursync.copy()
+            target['name'] = "{}{}".format(cursync['name'], index + 1)
+            target['destination'] = destination
+            target['target'] = index + 1
+            target['1'] = Event()
+            if index and Common.checkkey(cursync,'pipeline'):
+                target['source'] = destinations[0]
+                target['upstream'] = targets[0]
+            target['list1'] = ChangeSet(Common.checkkey(target,'source'), cursync['incrementalmax'])
+            targets.append(target)
+        group = [target for target in targets if not 'upstream' in target]
+        for target in group:
+            target['group'] = group
+        targets[0]['downstream'] = [target for target in targets if 'upstream' in target]
+        return targets
+
     def title(self):
         print("SyncWatch file and folder synchronization")
         print("Version: " + VERSION)
@@ -592,9 +3440,41 @@ class SyncWatch(object):
                 exit(1)
         return (LoggerPath)
 
+    def GetJournalPath(self):
+        journalpath = Common.checkkey(self.settings,'journaldir')
+        if journalpath == None:
+            journalpath = JOURNAL_DIR
+            # first look in lib path, then in home folder
+            if not os.access(os.path.dirname(journalpath), os.W_OK):
+                journalpath = os.path.join(os.path.expanduser('~'),".syncwatch")
+        if journalpath:
+            try:
+                os.makedirs(journalpath, exist_ok=True)
+            except Exception as e:
+                self.logger.error("Error creating journal folder {}, changes are not kept after a restart: {}".format(journalpath, e))
+                journalpath = None
+        return journalpath
+
     def exit_app(self, signum, frame):
         self.exitevent.set()
 
+    def reload_app(self, signum, frame):
+        self.reloadevent.set()
+
+    def log_status(self, signum, frame):
+        # logged by the main loop, the handler may interrupt it while holding the scheduler lock
+        self.statusevent.set()
+
+    def LogStatus(self):
+        if self.scheduler:
+            stats = self.scheduler.getStats()
+            self.logger.info("Status: {} syncs running, {} waiting".format(stats["running"], stats["queued"]))
+            for name, waittime in stats["jobs"].items():
+                status = "{}: {} syncs started, last wait {:.1f}s, max wait {:.1f}s".format(name, waittime["count"], waittime["last"], waittime["max"])
+                if "waiting" in waittime:
+                    status += ", waiting for {:.1f}s".format(waittime["waiting"])
+                self.logger.info(status)
+
 #########################################################
 if __name__ == "__main__":
     SyncWatch().run(sys.argv[1:])